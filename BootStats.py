@@ -0,0 +1,31 @@
+from collections import namedtuple
+
+
+BootSummary = namedtuple('BootSummary', ['count', 'mean', 'median', 'p90'])
+
+
+class BootStats:
+    """
+    Rolling boot times, in seconds from asking GCE for a node until its compute_worker ran.
+
+    Samples are kept per kind of node, e.g. "cpu-n1-standard-1" or "gpu-n1-standard-8-warm" for
+    nodes started from the warm pool, and only the last window of each are remembered. samples is
+    the 'boot' section of the states, so the figures survive restarts of the controller.
+    """
+
+    def __init__(self, samples, window=20):
+        self.samples = samples
+        self.window = window
+
+    def add(self, kind, seconds):
+        samples = self.samples.setdefault(kind, [])
+        samples.append(round(seconds, 1))
+        del samples[:-self.window]
+
+    def summary(self, kind):
+        samples = sorted(self.samples.get(kind) or [])
+        if not samples:
+            return None
+        count = len(samples)
+        return BootSummary(count, sum(samples) / count, samples[count // 2],
+                           samples[min(count - 1, int(0.9 * count))])
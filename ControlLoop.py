@@ -0,0 +1,55 @@
+import logging
+import random
+import signal
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class ControlLoop:
+    """
+    Runs a tick function over and over until asked to stop.
+
+    Ticks never overlap: the next one is scheduled interval seconds (plus or minus a random jitter)
+    after the previous one started, or right away if the previous one overran. SIGTERM and SIGINT
+    let the running tick finish and then end the loop.
+    """
+
+    def __init__(self, tick, interval, jitter=0.1):
+        self.tick = tick
+        self.interval = interval
+        self.jitter = jitter
+        self.stop_event = threading.Event()
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self, max_ticks=None):
+        ticks = 0
+        while not self.stop_event.is_set():
+            started = time.monotonic()
+            try:
+                self.tick()
+            except Exception:
+                # A failed tick must not take the daemon down, the next one may well succeed
+                logger.exception('Tick failed')
+
+            ticks += 1
+            if max_ticks and ticks >= max_ticks:
+                break
+
+            self.stop_event.wait(self.next_delay(time.monotonic() - started))
+
+    def next_delay(self, elapsed):
+        interval = self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+        return max(0, interval - elapsed)
+
+    def _handle_signal(self, signum, frame):
+        logger.info('Received signal %s, stopping after the current tick', signum)
+        self.stop()
@@ -0,0 +1,176 @@
+import gzip
+import json
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+def new_index():
+    # The 'journal' section of the states: seq of the last line, node name -> [status, ticks in
+    # it] as of that line, lines not in S3 yet and the S3 objects holding the others
+    return {'seq': 0, 'nodes': {}, 'pending': [], 'batches': [], 'segments': [], 'snapshot': None}
+
+
+def apply_line(nodes, line):
+    # Nodes keep their status, and count another tick in it, unless the line says otherwise
+    for name in line.get('gone', ()):
+        nodes.pop(name, None)
+    changed = line.get('nodes') or {}
+    for name, entry in nodes.items():
+        if name not in changed:
+            entry[1] += 1
+    for name, status in changed.items():
+        nodes[name] = [status, 1]
+
+
+class DecisionJournal:
+    """
+    Append-only history of what every tick saw and decided.
+
+    One json line per tick: its seq and time, the status of the nodes that changed since the line
+    before and the nodes that are gone, the fleet load and the action taken. How many ticks a node
+    has been in its status follows from the lines, see apply_line(). Lines go to the local file
+    right away and to S3 every batch_ticks ticks, one new object per batch, so a write is the same
+    size however large the history gets.
+
+    Once segment_batches batches piled up they are compacted into one gzipped segment, next to a
+    snapshot of the node states as of its last line, and segments beyond keep_segments are
+    deleted. load() rebuilds the node states from the latest snapshot and the lines after it.
+
+    index is the 'journal' section of the states, see new_index().
+    """
+
+    def __init__(self, s3_client, bucket_name, prefix, local_location=None, batch_ticks=10, segment_batches=144,
+                 keep_segments=30):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.local_location = local_location
+        self.batch_ticks = batch_ticks
+        self.segment_batches = segment_batches
+        self.keep_segments = keep_segments
+
+    def record(self, index, time, statuses, load, action, count):
+        nodes = index['nodes']
+        line = {'seq': index['seq'] + 1, 't': time}
+        changed = {name: status for name, status in statuses.items() if name not in nodes or nodes[name][0] != status}
+        gone = [name for name in nodes if name not in statuses]
+        if changed:
+            line['nodes'] = changed
+        if gone:
+            line['gone'] = gone
+        line.update(load=load, action=action, count=count)
+
+        apply_line(nodes, line)
+        index['seq'] = line['seq']
+        index['pending'].append(line)
+
+        if self.local_location:
+            with open(self.local_location, 'a') as f:
+                f.write(json.dumps(line) + '\n')
+        return line
+
+    def flush(self, index):
+        """Writes a batch to S3 once batch_ticks lines are pending, compacting when it is time."""
+        if len(index['pending']) < self.batch_ticks:
+            return
+
+        key = self._key('batch', index['pending'][0]['seq'], '.jsonl')
+        self._put(key, self._encode(index['pending']))
+        index['batches'].append(key)
+        index['pending'] = []
+
+        if len(index['batches']) >= self.segment_batches:
+            self.compact(index)
+
+    def compact(self, index):
+        if not index['batches']:
+            return
+        body = b''.join(self._get(key) for key in index['batches'])
+        segment = self._key('segment', self._first_seq(index['batches'][0]), '.jsonl.gz')
+        self._put(segment, gzip.compress(body))
+
+        # Batches are all written, the node states are the ones as of the segment's last line
+        snapshot = self._key('snapshot', index['seq'], '.json')
+        self._put(snapshot, json.dumps({'seq': index['seq'], 'nodes': index['nodes']}).encode('utf-8'))
+
+        segments = index['segments'] + [segment]
+        stale = index['batches'] + segments[:-self.keep_segments]
+        if index['snapshot']:
+            stale.append(index['snapshot'])
+        index['segments'] = segments[-self.keep_segments:]
+        index['snapshot'] = snapshot
+        index['batches'] = []
+        for key in stale:
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=key)
+        logger.info('Compacted the journal into %s', segment)
+
+        if self.local_location and os.path.exists(self.local_location):
+            os.replace(self.local_location, self.local_location + '.1')
+
+    def load(self):
+        """
+        Rebuilds the index from S3 alone, for when the states are lost: the node states of the
+        latest snapshot with the lines of the batches and segments after it applied.
+        """
+        keys = self._list()
+        index = new_index()
+        snapshots = sorted(key for key in keys if self._kind(key) == 'snapshot')
+        snapshot_seq = 0
+        if snapshots:
+            snapshot = json.loads(self._get(snapshots[-1]))
+            snapshot_seq = snapshot['seq']
+            index.update(seq=snapshot_seq, nodes=snapshot['nodes'], snapshot=snapshots[-1])
+
+        for line in self.lines(keys, after=index['seq']):
+            apply_line(index['nodes'], line)
+            index['seq'] = line['seq']
+        index['segments'] = sorted(key for key in keys if self._kind(key) == 'segment')[-self.keep_segments:]
+        index['batches'] = sorted(key for key in keys
+                                  if self._kind(key) == 'batch' and self._first_seq(key) > snapshot_seq)
+        return index
+
+    def lines(self, keys=None, after=0):
+        # Every line still in S3 after seq after, oldest first
+        if keys is None:
+            keys = self._list()
+        objects = sorted((self._first_seq(key), key) for key in keys if self._kind(key) in ('batch', 'segment'))
+        for _, key in objects:
+            body = self._get(key)
+            if key.endswith('.gz'):
+                body = gzip.decompress(body)
+            for raw in body.splitlines():
+                line = json.loads(raw)
+                if line['seq'] > after:
+                    yield line
+
+    def _key(self, kind, seq, extension):
+        # Zero padded so keys sort by seq
+        return '{}{}-{:010d}{}'.format(self.prefix, kind, seq, extension)
+
+    def _kind(self, key):
+        return key[len(self.prefix):].split('-', 1)[0]
+
+    def _first_seq(self, key):
+        return int(key[len(self.prefix):].split('-', 1)[1].split('.', 1)[0])
+
+    def _encode(self, lines):
+        return ''.join(json.dumps(line) + '\n' for line in lines).encode('utf-8')
+
+    def _put(self, key, body):
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=key, Body=body)
+
+    def _get(self, key):
+        return self.s3_client.get_object(Bucket=self.bucket_name, Key=key)['Body'].read()
+
+    def _list(self):
+        keys = []
+        arguments = {'Bucket': self.bucket_name, 'Prefix': self.prefix}
+        while True:
+            response = self.s3_client.list_objects_v2(**arguments)
+            keys.extend(entry['Key'] for entry in response.get('Contents', ()))
+            if not response.get('IsTruncated'):
+                return keys
+            arguments['ContinuationToken'] = response['NextContinuationToken']
@@ -1,11 +1,15 @@
 import io
-
+import json
+import logging
 import os
-import paramiko
-from paramiko import ssh_exception
-import yaml
+import threading
 from socket import timeout
 
+from HostKeyStore import HostKeyStore
+from Metrics import Metrics
+from ProbeEngine import ProbeEngine
+from SSHConnectionPool import SSHConnectionPool
+
 
 # TODO: When paramiko is updated > 2.4.2 remove this warning squelch
 # Last checked March 14, 2019
@@ -14,10 +18,10 @@ warnings.filterwarnings(action='ignore', module='.*paramiko.*')
 
 
 # Uncomment to enable paramiko logging
-# import logging
-# logging.basicConfig()
 # logging.getLogger("paramiko").setLevel(logging.DEBUG)
 
+logger = logging.getLogger(__name__)
+
 
 class ElasticCloudAdapter:
 
@@ -25,7 +29,9 @@ class ElasticCloudAdapter:
     ACTION_EXPAND = 'expand'
     ACTION_DO_NOTHING = 'do_nothing'
 
-    def __init__(self, provider_name):
+    def __init__(self, provider_name, metrics=None):
+        # Pools of one controller share their metrics, see GCEAdapter.pool_adapters()
+        self.metrics = metrics or Metrics()
         self._load_configuration(provider_name)
         self._load_ssh_configuration()
 
@@ -35,6 +41,7 @@ class ElasticCloudAdapter:
 
         # Load config from yaml OR from environment
         if os.path.exists(config_filename):
+            import yaml
             with open(config_filename) as f:
                 service_config = yaml.load(f, Loader=yaml.FullLoader)
         else:
@@ -50,6 +57,52 @@ class ElasticCloudAdapter:
                         'use_gpus': os.environ.get('GCE_USE_GPUS'),
                         'vm_size': os.environ.get('GCE_VM_SIZE', "n1-standard-1"),
                         'datacenter': os.environ.get('GCE_DATACENTER', "us-west1-a"),
+                        'zones': os.environ.get('GCE_ZONES'),
+                        'accelerator_type': os.environ.get('GCE_ACCELERATOR_TYPE'),
+                        'accelerator_count': os.environ.get('GCE_ACCELERATOR_COUNT'),
+                        # Pool name -> settings overriding the ones above, as json
+                        'pools': json.loads(os.environ.get('GCE_POOLS') or 'null'),
+                        'probe_concurrency': int(os.environ.get('GCE_PROBE_CONCURRENCY', 10)),
+                        'probe_deadline': int(os.environ.get('GCE_PROBE_DEADLINE', 30)),
+                        'ssh_max_sessions': int(os.environ.get('GCE_SSH_MAX_SESSIONS', 50)),
+                        'ssh_idle_timeout': int(os.environ.get('GCE_SSH_IDLE_TIMEOUT', 300)),
+                        'ssh_keepalive': int(os.environ.get('GCE_SSH_KEEPALIVE', 30)),
+                        'ssh_host_key_cache': os.environ.get('GCE_SSH_HOST_KEY_CACHE'),
+                        'state_lease_ttl': int(os.environ.get('GCE_STATE_LEASE_TTL', 300)),
+                        'create_concurrency': int(os.environ.get('GCE_CREATE_CONCURRENCY', 10)),
+                        'gce_requests_per_second': float(os.environ.get('GCE_REQUESTS_PER_SECOND', 10)),
+                        'gce_request_burst': int(os.environ.get('GCE_REQUEST_BURST', 20)),
+                        'gce_max_retries': int(os.environ.get('GCE_MAX_RETRIES', 5)),
+                        'gce_retry_delay': float(os.environ.get('GCE_RETRY_DELAY', 0.5)),
+                        'drain_deadline': int(os.environ.get('GCE_DRAIN_DEADLINE', 60)),
+                        'billing_seconds': int(os.environ.get('GCE_BILLING_SECONDS', 0)),
+                        'load_signal': os.environ.get('GCE_LOAD_SIGNAL', 'ssh'),
+                        'broker_queue': os.environ.get('GCE_BROKER_QUEUE', 'compute-worker'),
+                        'broker_management_url': os.environ.get('GCE_BROKER_MANAGEMENT_URL'),
+                        'jobs_per_node': int(os.environ.get('GCE_JOBS_PER_NODE', 1)),
+                        'scaling_policy': os.environ.get('GCE_SCALING_POLICY', 'counter'),
+                        'target_utilization': float(os.environ.get('GCE_TARGET_UTILIZATION', 0.75)),
+                        'utilization_band': float(os.environ.get('GCE_UTILIZATION_BAND', 0.15)),
+                        'max_scale_step': int(os.environ.get('GCE_MAX_SCALE_STEP', 0)),
+                        'scale_up_cooldown': int(os.environ.get('GCE_SCALE_UP_COOLDOWN', 0)),
+                        'scale_down_cooldown': int(os.environ.get('GCE_SCALE_DOWN_COOLDOWN', 0)),
+                        'predictive_scaling': os.environ.get('GCE_PREDICTIVE_SCALING'),
+                        'trend_window': int(os.environ.get('GCE_TREND_WINDOW', 5)),
+                        'metrics_textfile': os.environ.get('GCE_METRICS_TEXTFILE'),
+                        'journal': os.environ.get('GCE_JOURNAL'),
+                        'journal_batch_ticks': int(os.environ.get('GCE_JOURNAL_BATCH_TICKS', 10)),
+                        'journal_segment_batches': int(os.environ.get('GCE_JOURNAL_SEGMENT_BATCHES', 144)),
+                        'journal_keep_segments': int(os.environ.get('GCE_JOURNAL_KEEP_SEGMENTS', 30)),
+                        'probe_mode': os.environ.get('GCE_PROBE_MODE', 'ssh'),
+                        'heartbeat_url': os.environ.get('GCE_HEARTBEAT_URL'),
+                        'heartbeat_port': int(os.environ.get('GCE_HEARTBEAT_PORT', 8111)),
+                        'heartbeat_address': os.environ.get('GCE_HEARTBEAT_ADDRESS', '0.0.0.0'),
+                        'heartbeat_token': os.environ.get('GCE_HEARTBEAT_TOKEN'),
+                        'heartbeat_timeout': int(os.environ.get('GCE_HEARTBEAT_TIMEOUT', 90)),
+                        'heartbeat_sidecar': os.environ.get('GCE_HEARTBEAT_SIDECAR'),
+                        'warm_pool_size': int(os.environ.get('GCE_WARM_POOL_SIZE', 0)),
+                        'stop_on_shrink': os.environ.get('GCE_STOP_ON_SHRINK'),
+                        'warm_pool_startup_script': os.environ.get('GCE_WARM_POOL_STARTUP_SCRIPT'),
                         'service_account_key': os.environ.get('GCE_SERVICE_ACCOUNT_KEY'),
                         'service_account_file': os.environ.get('GCE_SERVICE_ACCOUNT_FILE'),
                     }
@@ -60,13 +113,29 @@ class ElasticCloudAdapter:
         self.config['BROKER_URL'] = service_config['BROKER_URL']
     
     def _load_ssh_configuration(self):
+        # Host keys of workers are tracked per instance in memory, ~/.ssh/known_hosts is left alone
+        self.host_key_store = HostKeyStore(self.config.get('ssh_host_key_cache'))
+
+        # Authenticated ssh clients are reused across commands and ticks, one per host so nodes
+        # can be probed concurrently
+        self.ssh_pool = SSHConnectionPool(self._connect,
+                                          max_sessions=int(self.config.get('ssh_max_sessions', 50)),
+                                          idle_timeout=int(self.config.get('ssh_idle_timeout', 300)),
+                                          keepalive_interval=int(self.config.get('ssh_keepalive', 30)))
+
+        self.probe_engine = ProbeEngine(self._run_ssh_probe,
+                                        concurrency=int(self.config.get('probe_concurrency', 10)),
+                                        deadline=int(self.config.get('probe_deadline', 30)))
+
+        # The key is read, and paramiko imported, on the first connection
+        self.pkey = None
+        self._ssh_key_lock = threading.Lock()
+
+    def _load_ssh_key(self):
+        import paramiko
+
         # Paramiko ssh library set up
         ssh_config_filename = os.path.expanduser('~/.ssh/config')
-
-        self.ssh_client = paramiko.SSHClient()
-        self.ssh_client.load_system_host_keys()
-        self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        
         config = paramiko.config.SSHConfig()
 
         try:
@@ -83,58 +152,103 @@ class ElasticCloudAdapter:
             self.username = "ubuntu"
 
             ssh_key = os.environ.get("GCE_SSH_PRIV")
-            print(f"Unable to find ElasticCloud SSHConfig, attempting to use GCE_SSH_PRIV env var = \n{ssh_key}")
+            logger.warning("Unable to find ElasticCloud SSHConfig, attempting to use GCE_SSH_PRIV env var")
             if ssh_key:
                 self.pkey = paramiko.RSAKey.from_private_key(io.StringIO(ssh_key))
             else:
                 # try to use default local one
                 self.pkey = paramiko.RSAKey.from_private_key_file(os.path.expanduser("~/.ssh/id_rsa"))
 
+    def _new_ssh_client(self):
+        import paramiko
+
+        ssh_client = paramiko.SSHClient()
+        ssh_client.set_missing_host_key_policy(self.host_key_store.policy())
+        return ssh_client
+
     def _connect(self, host):
-        # Delete old known hosts entry for GCE VM ip address
-        known_hosts_filename = os.path.expanduser('~/.ssh/known_hosts')
-        if os.path.exists(known_hosts_filename):
-            kh = None
-            with open(known_hosts_filename, 'r') as f:
-                kh = f.readlines()
-            with open(known_hosts_filename, 'w') as f:
-                for line in kh:
-                    line_ip = line.split()[0]
-                    if not line_ip == host:
-                        f.write(line)
+        from paramiko import ssh_exception
+
+        with self._ssh_key_lock:
+            if self.pkey is None:
+                self._load_ssh_key()
+
+        ssh_client = self._new_ssh_client()
         try:
-            print(f"Attempting to connect to {self.username}@{host}")
-            self.ssh_client.connect(host, username=self.username, pkey=self.pkey, timeout=10)
+            logger.debug("Attempting to connect to %s@%s", self.username, host)
+            with self.metrics.external_call('ssh', 'connect'):
+                ssh_client.connect(host, username=self.username, pkey=self.pkey, timeout=10)
         except (ssh_exception.NoValidConnectionsError, ssh_exception.AuthenticationException):
-            print("ERROR :: Could not connect to host, maybe it is spinning up/down?")
+            logger.warning("Could not connect to %s, maybe it is spinning up/down?", host)
             raise
         except timeout:
-            print('ssh timed out')
+            logger.warning('ssh to %s timed out', host)
             raise
         except Exception as e:
-            print(e)
+            logger.error('ssh to %s failed: %s', host, e)
             raise
+        return ssh_client
 
     def _run_ssh_command(self, host, command):
+        from paramiko import ssh_exception
+
+        # Connection errors have already been reported by _connect, let callers decide what to do
+        ssh_client = self.ssh_pool.get(host)
         try:
-            self._connect(host)
-        except timeout:
-            print('ssh timed out')
-            raise
-        except (ssh_exception.NoValidConnectionsError, ssh_exception.AuthenticationException):
-            print("ERROR :: Could not connect to host, maybe it is spinning down?")
-        try:
-            stdin, stdout, stderr = self.ssh_client.exec_command(command)
-        except (ssh_exception.NoValidConnectionsError, ssh_exception.AuthenticationException):
-            print("ERROR :: Could not exec command on host, maybe it is spinning up/down?")
+            with self.metrics.external_call('ssh', 'exec_command'):
+                stdin, stdout, stderr = ssh_client.exec_command(command)
+        except ssh_exception.SSHException:
+            # The pooled connection may have gone stale since the last tick, retry once on a fresh one
+            self.ssh_pool.discard(host)
+            ssh_client = self.ssh_pool.get(host)
+            try:
+                with self.metrics.external_call('ssh', 'exec_command'):
+                    stdin, stdout, stderr = ssh_client.exec_command(command)
+            except ssh_exception.SSHException:
+                logger.warning("Could not exec command on %s, maybe it is spinning up/down?", host)
+                self.ssh_pool.discard(host)
+                raise
         return (stdin, stdout, stderr)
 
+    def _run_ssh_probe(self, host, command):
+        (stdin, stdout, stderr) = self._run_ssh_command(host, command)
+        return stdout.readlines()
+
+    def begin_tick(self):
+        # Called once at the start of every control loop tick
+        self.ssh_pool.evict_idle()
+
+    def end_tick(self):
+        # Called once at the end of every control loop tick
+        self.host_key_store.flush()
+        self.metrics.inc('ticks_total')
+        if self.config.get('metrics_textfile'):
+            self.metrics.write_textfile(self.config['metrics_textfile'])
+
+    def close(self):
+        self.ssh_pool.close_all()
+        self.host_key_store.flush()
+
+    def plan(self, snapshot=None):
+        raise NotImplementedError
+
+    def apply(self, plan, snapshot=None):
+        raise NotImplementedError
+
     def expand(self):
         raise NotImplementedError
 
     def shrink(self):
         raise NotImplementedError
 
+    def pool_adapters(self):
+        # Providers without pools manage a single fleet
+        return [self]
+
+    def refill_warm_pool(self, snapshot=None):
+        # Providers without a warm pool have nothing to do
+        return None
+
     def dump_state(self):
         raise NotImplementedError
 
@@ -0,0 +1,88 @@
+import time
+from collections import namedtuple
+from datetime import datetime
+
+
+SnapshotNode = namedtuple('SnapshotNode', ['name', 'ip', 'created', 'status', 'node'])
+
+# libcloud node states of instances that exist but do not run, GCE TERMINATED and SUSPENDED
+PARKED_STATES = ('stopped', 'suspended')
+# GCE statuses libcloud folds into pending while an instance shuts down
+PARKING_STATUSES = ('STOPPING', 'SUSPENDING')
+
+
+class FleetSnapshot:
+    """
+    Point-in-time view of the nodes managed by elastic cloud.
+
+    Built from a single list_nodes() call and shared by everything that runs during one control
+    loop tick, so lookups by name, ip or age no longer go back to the provider API. Once nodes are
+    created or destroyed the snapshot must be invalidated so the next tick builds a fresh one.
+
+    Stopped instances, and the ones named in warming, make up the warm pool. They are kept apart
+    from the running fleet that everything else works on.
+
+    created is either the datetime format of the node names or a dict of node name -> creation
+    time, as list_nodes() already parsed them.
+    """
+
+    def __init__(self, nodes, created, warming=()):
+        self.taken_at = time.time()
+        self.valid = True
+        # NodeMetrics of the running nodes, filled in by the first probe of the tick
+        self.probes = None
+        self._nodes = {}
+        self._pool = {}
+        # Running nodes oldest first, sorted on the first oldest() call
+        self._by_age = None
+
+        for node in nodes:
+            ip = node.public_ips[0] if node.public_ips else None
+            if isinstance(created, dict):
+                node_created = created[node.name]
+            else:
+                node_created = datetime.strptime(node.name[-23:-4], created)
+            entry = SnapshotNode(node.name, ip, node_created, node.state, node)
+            if node.state in PARKED_STATES or node.extra.get('status') in PARKING_STATUSES or node.name in warming:
+                self._pool[node.name] = entry
+            else:
+                self._nodes[node.name] = entry
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, node_name):
+        return node_name in self._nodes
+
+    def __iter__(self):
+        return iter(self._nodes.values())
+
+    def get(self, node_name):
+        return self._nodes.get(node_name)
+
+    def names(self):
+        return list(self._nodes)
+
+    def nodes(self):
+        return [entry.node for entry in self._nodes.values()]
+
+    def ip(self, node_name):
+        entry = self._nodes.get(node_name)
+        return entry.ip if entry else None
+
+    def oldest(self, n):
+        if self._by_age is None:
+            self._by_age = [entry.node for entry in sorted(self._nodes.values(), key=lambda entry: (entry.created, entry.name))]
+        return self._by_age[0:n]
+
+    def pool_names(self):
+        return list(self._pool)
+
+    def warm(self):
+        # Stopped nodes that can be started right away, most recently created first
+        entries = [entry for entry in self._pool.values() if entry.status == 'stopped']
+        entries.sort(key=lambda entry: entry.created, reverse=True)
+        return [entry.node for entry in entries]
+
+    def invalidate(self):
+        self.valid = False
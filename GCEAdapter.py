@@ -1,20 +1,66 @@
 import json
+import logging
+import math
 import os
-import json
 import copy
+import re
+import threading
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from socket import timeout
-from distutils.util import strtobool
 
-from paramiko import ssh_exception
-from libcloud.compute.types import Provider
-from libcloud.compute.providers import get_driver
-import boto3
 from botocore.exceptions import ClientError
-from libcloud.common.google import GoogleBaseError
 
+from BootStats import BootStats
+from DecisionJournal import DecisionJournal, new_index
 from ElasticCloudAdapter import ElasticCloudAdapter
+from FleetSnapshot import FleetSnapshot
+from GCEClient import GCEClient
+from Heartbeats import HeartbeatStore, node_token
+from LazyClient import LazyClient
+from LoadSignal import load_signal_from_config
+from NodeMetrics import PROBE_COMMAND, parse_probe
+from ScalingPlan import ScalingPlan, StalePlanError
+from ScalingPolicy import FleetLoad, scaling_policy_from_config
+from StateStore import StateStore
+from VictimSelection import Candidate, select_victims
+
+
+logger = logging.getLogger(__name__)
+
+
+def strtobool(value):
+    # Same answers as distutils.util.strtobool, distutils is slow to import and gone in Python 3.12
+    value = value.lower()
+    if value in ('y', 'yes', 't', 'true', 'on', '1'):
+        return 1
+    if value in ('n', 'no', 'f', 'false', 'off', '0'):
+        return 0
+    raise ValueError('invalid truth value {!r}'.format(value))
+
+# Pool of the nodes created before pools were configured, its node names carry no pool
+DEFAULT_POOL = 'default'
+
+# GCE error codes of a zone that has no capacity, or no quota, left for another node
+CAPACITY_ERRORS = ('ZONE_RESOURCE_POOL_EXHAUSTED', 'ZONE_RESOURCE_POOL_EXHAUSTED_WITH_DETAILS', 'QUOTA_EXCEEDED')
+
+# Startup script of new nodes in heartbeat mode, has the sidecar in their metadata install itself.
+# The warm pool startup script runs the same line.
+HEARTBEAT_INSTALL = ('#!/bin/bash\ncurl -sf -H "Metadata-Flavor: Google" '
+                     'http://metadata.google.internal/computeMetadata/v1/instance/attributes/elastic-cloud-heartbeat-script'
+                     ' | bash -s install\n')
+
+
+def owned_node_pattern(pool=None):
+    # Names of the nodes elastic cloud creates: cpu-/gpu-, the pool and the creation time, see
+    # _new_node_names(). The creation time is always the last 23 characters.
+    pool_part = '{}-'.format(pool) if pool and pool != DEFAULT_POOL else ''
+    return '(cpu|gpu)-' + pool_part + '[0-9]{2}-[0-9]{2}-[0-9]{4}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{3}'
+
+
+def is_capacity_error(error):
+    return getattr(error, 'code', None) in CAPACITY_ERRORS
 
 
 class GCEAdapter(ElasticCloudAdapter):
@@ -23,36 +69,115 @@ class GCEAdapter(ElasticCloudAdapter):
     CONTAINER_RUNNING = 'RUNNING'
     CONTAINER_STOPPING = 'STOPPING'
     CONTAINER_STOPPED = 'STOPPED'
-    INITIALIZING = True
-
-    def __init__(self):
-        super().__init__('gce')
-
+    # Warm pool nodes, booting to pull the worker image and powering off, then stopped
+    CONTAINER_WARMING = 'WARMING'
+    CONTAINER_WARM = 'WARM'
+    # Node state reported when a node could not be probed this tick
+    NODE_UNKNOWN = 'UNKNOWN'
+    # Set while the states are built from scratch, see _bootstrap_states()
+    INITIALIZING = False
+
+    def __init__(self, pool=None, metrics=None, heartbeats=None, gce_client=None):
+        super().__init__('gce', metrics)
+
+        self.pool = pool
+        # GCE rate limits requests per project, the adapters of all pools share one client
+        self.gce_client = gce_client
         self._configure()
         self.gce = self._load_gce_account()
+        # Drivers used by worker threads when creating, starting and stopping nodes concurrently
+        self._worker_drivers = threading.local()
+
+        # Warm pool nodes are created in the background, see refill_warm_pool()
+        self._refill_executor = None
+        self._refilling = set()
+        self._refill_lock = threading.Lock()
+        self._last_name_stamp = None
+        self._name_sequence = 0
 
         # Used to format node names (datetime formatting)
         self.format = '%m-%d-%Y-%H-%M-%S'
-        
-        self._load_boto_client()
 
-        GCEAdapter.INITIALIZING = False
+        # Fleet view shared by everything that runs during one tick, see get_snapshot()
+        self.snapshot = None
+        # Node states and FleetLoad the last get_next_action decided on
+        self.last_observation = None
+        # Node name -> creation time parsed from it, None for names elastic cloud did not make
+        self._created_at = {}
 
+        # Pushed by the workers in heartbeat probe mode, see start_heartbeat_server()
+        self.heartbeats = heartbeats or HeartbeatStore(lambda: self._now().timestamp())
+        self.heartbeat_server = None
+        
+        self._load_boto_client()
 
     def _configure(self):
+        if self.pool is not None:
+            # Settings of a pool override the ones of the gce block
+            pools = self.config.get('pools') or {}
+            if self.pool not in pools:
+                raise ValueError('No pool named {!r} in the config'.format(self.pool))
+            if not re.fullmatch('[a-z][a-z0-9]*', self.pool):
+                raise ValueError('Pool names are lowercase letters and digits, not {!r}'.format(self.pool))
+            self.config = dict(self.config, **(pools[self.pool] or {}))
+            self.config.pop('pools')
+
         # From config.yaml
         self.service_account_key = self.config.get('service_account_key')
         # If above key is given, this path points to a temp storage version of the above key -- it
         # will be overwritten!
         self.service_account_key_path = self.config['service_account_file']
         self.datacenter = self.config['datacenter']
+        # Nodes go to the first zone with capacity for them
+        zones = self.config.get('zones') or [self.datacenter]
+        if isinstance(zones, str):
+            zones = [zone.strip() for zone in zones.split(',') if zone.strip()]
+        self.zones = zones
         self.image = self.config['image_name']
         self.size = self.config['vm_size']
         self.max_nodes = self.config['max']
         self.min_nodes = self.config['min']
         self.EXPAND_CRITERION = self.config['expand_sensitivity']
         self.SHRINK_CRITERION = self.config['shrink_sensitivity']
+        self.state_lease_ttl = int(self.config.get('state_lease_ttl', 300))
+        self.create_concurrency = int(self.config.get('create_concurrency', 10))
+        self.drain_deadline = int(self.config.get('drain_deadline', 60))
+        self.billing_seconds = int(self.config.get('billing_seconds') or 0)
+        self.jobs_per_node = int(self.config.get('jobs_per_node', 1))
+        self.load_signal = load_signal_from_config(self.config)
+        self.scaling_policy = scaling_policy_from_config(self.config)
         self.use_gpus = strtobool(str(self.config.get("use_gpus", "False")))
+        self.accelerator_type = self.config.get('accelerator_type') or 'nvidia-tesla-p100'
+        self.accelerator_count = int(self.config.get('accelerator_count') or 1)
+        self.node_name_pattern = re.compile(owned_node_pattern(self.pool))
+        # GCE only sends back instances named like the ones of this pool
+        self.node_filter = 'name eq "{}"'.format(self.node_name_pattern.pattern)
+        self.warm_pool_size = int(self.config.get('warm_pool_size') or 0)
+        self.stop_on_shrink = strtobool(str(self.config.get('stop_on_shrink') or 'False'))
+        self.warm_pool_startup_script = self.config.get('warm_pool_startup_script') or 'scripts/GCE_Warm_Pool_Startup.sh'
+        self.probe_mode = self.config.get('probe_mode') or 'ssh'
+        self.heartbeat_url = self.config.get('heartbeat_url')
+        self.heartbeat_port = int(self.config.get('heartbeat_port') or 8111)
+        self.heartbeat_address = self.config.get('heartbeat_address') or '0.0.0.0'
+        self.heartbeat_token = self.config.get('heartbeat_token')
+        self.heartbeat_timeout = int(self.config.get('heartbeat_timeout') or 90)
+        self.heartbeat_sidecar = self.config.get('heartbeat_sidecar') or 'scripts/GCE_Heartbeat_Sidecar.sh'
+        self.journal_enabled = strtobool(str(self.config.get('journal') or 'False'))
+        # Shared by the GCE drivers of all threads and pools, see GCEClient
+        if self.gce_client is None:
+            requests_per_second = self.config.get('gce_requests_per_second')
+            self.gce_client = GCEClient(float(10 if requests_per_second is None else requests_per_second),
+                                        int(self.config.get('gce_request_burst') or 20),
+                                        int(self.config.get('gce_max_retries', 5)),
+                                        float(self.config.get('gce_retry_delay', 0.5)),
+                                        metrics=self.metrics)
+        if self.probe_mode == 'heartbeat' and not self.heartbeat_url:
+            raise ValueError('probe_mode heartbeat needs the heartbeat_url workers reach the controller on')
+        if self.probe_mode == 'heartbeat' and not self.heartbeat_token:
+            raise ValueError('probe_mode heartbeat needs the heartbeat_token the node credentials derive from')
+        self._configure_cloudcube()
+
+    def _configure_cloudcube(self):
         self.CLOUDCUBE_URL = os.environ['CLOUDCUBE_URL']
         self.CLOUDCUBE_ACCESS_KEY_ID = os.environ['CLOUDCUBE_ACCESS_KEY_ID']
         self.CLOUDCUBE_SECRET_ACCESS_KEY = os.environ['CLOUDCUBE_SECRET_ACCESS_KEY']
@@ -61,111 +186,232 @@ class GCEAdapter(ElasticCloudAdapter):
         service_account = None
 
         if self.service_account_key:
-            print("Loading service account key directly, not reading from file path")
+            logger.info("Loading service account key directly, not reading from file path")
             service_account = json.loads(self.service_account_key)
             self.service_account_key_path = "gce_service_key_temp_store.json"
             with open(self.service_account_key_path, "w") as f:
                 f.write(self.service_account_key)
 
         else:
-            print(f"Reading from service account key path: {self.service_account_key_path}")
+            logger.info("Reading from service account key path: %s", self.service_account_key_path)
             with open(self.service_account_key_path) as f:
                 service_account = json.load(f)
 
-        Driver = get_driver(Provider.GCE)
+        self.service_account = service_account
         self.service_account_email = service_account['client_email']
 
+        # libcloud authenticates when the driver is built, wait until a command needs GCE
+        return LazyClient(lambda: self.gce_client.wrap(self._new_gce_driver()))
+
+    def _new_gce_driver(self):
+        from GCEDriver import FilteredGCENodeDriver
+
+        driver = FilteredGCENodeDriver(self.service_account['client_email'],
+                        self.service_account_key_path,
+                        datacenter=self.datacenter,
+                        project=self.service_account['project_id'])
+        return self.metrics.instrument(driver, 'gce')
+
+    def _new_s3_client(self):
+        import boto3
 
-        return Driver(service_account['client_email'],
-                      self.service_account_key_path,
-                      datacenter=self.datacenter,
-                      project=service_account['project_id'])
+        s3_client = boto3.client('s3', aws_access_key_id=self.CLOUDCUBE_ACCESS_KEY_ID, aws_secret_access_key=self.CLOUDCUBE_SECRET_ACCESS_KEY)
+        return self.metrics.instrument(s3_client, 's3')
 
     def _load_boto_client(self):
-        self.s3_client = boto3.client('s3', aws_access_key_id=self.CLOUDCUBE_ACCESS_KEY_ID, aws_secret_access_key=self.CLOUDCUBE_SECRET_ACCESS_KEY)
+        self.s3_client = LazyClient(self._new_s3_client)
         self.s3_bucket_name = 'cloud-cube'
         fs_prefix = self.CLOUDCUBE_URL[-12:]
         remote_location = '/gce_states'
-        self.s3_state_file_location = fs_prefix + remote_location
-        self.local_state_file_location = '.gce_states'
-        
-        try:
-            self.s3_client.download_file(self.s3_bucket_name, self.s3_state_file_location, self.local_state_file_location)
-        except ClientError:
-            print('Boto: ClientError')
-            if os.path.exists(self.local_state_file_location) and os.path.getsize(self.local_state_file_location) > 0:
-                self.s3_client.upload_file(self.local_state_file_location, self.s3_bucket_name, self.s3_state_file_location)
-            else:
-                print('local states did not exist')
-                new_states = {}
-                with open(self.local_state_file_location,'w+') as state_file:
-                    node_states = self.dump_state()
-                    print(node_states)
-                    new_states['node'] = node_states
-
-                    container_states = {}
-                    for name in node_states:
-                        container_states[name] = {}
-                        container_states[name]['status'] = self.CONTAINER_RUNNING
-
-                    new_states['container'] = container_states
-                    json.dump(new_states, state_file)
-                    
-                print(new_states)
-                self.s3_client.upload_file(self.local_state_file_location, self.s3_bucket_name, self.s3_state_file_location)
-                
-            
-        
+        self.s3_state_file_location = fs_prefix + remote_location + self._state_suffix()
+        self.local_state_file_location = '.gce_states' + self._state_suffix()
 
+        # States are downloaded the first time a command needs them, once per tick, and written
+        # back by end_tick()
+        self.state_store = StateStore(self.s3_client, self.s3_bucket_name, self.s3_state_file_location, self.local_state_file_location)
 
-    def list_nodes(self):
-        nodes = self.gce.list_nodes()
-        # Filter nodes that don't fit the datetime format. These nodes were probably created by the user and not by elastic cloud.
-
-        unfit_nodes = []
-
-        for n in nodes:
-            try:
-                datetime.strptime(n.name[4:-4], self.format)
-            except ValueError:
-                unfit_nodes.append(n)
+        self.journal = self._new_journal(fs_prefix + '/gce_journal' + self._state_suffix() + '/',
+                                         '.gce_journal' + self._state_suffix())
 
-        for n in unfit_nodes:
-            nodes.remove(n)
+    def _new_journal(self, prefix, local_location):
+        return DecisionJournal(self.s3_client, self.s3_bucket_name, prefix, local_location,
+                               int(self.config.get('journal_batch_ticks') or 10),
+                               int(self.config.get('journal_segment_batches') or 144),
+                               int(self.config.get('journal_keep_segments') or 30))
 
-        return nodes
+    def _state_suffix(self):
+        # Every pool has states of its own, the default pool keeps the ones from before pools
+        if self.pool is None or self.pool == DEFAULT_POOL:
+            return ''
+        return '_' + self.pool
 
-    def _get_oldest_nodes(self,n):
-        # use strptime to parse node names and compare
-        def calculate_key(node):
-            date = datetime.strptime(node.name[4:-4], self.format)
-            return date
+    def pool_adapters(self):
+        """
+        One adapter for every pool in the config, or just this one without pools. They share
+        this adapter's metrics, labelled with the pool, heartbeats and GCE client.
+        """
+        pools = self.config.get('pools')
+        if self.pool is not None or not pools:
+            return [self]
+        return [type(self)(pool, self.metrics.labelled(pool=pool), self.heartbeats, self.gce_client) for pool in pools]
+
+    def _bootstrap_states(self):
+        logger.warning('Could not read states from S3')
+        if os.path.exists(self.local_state_file_location) and os.path.getsize(self.local_state_file_location) > 0:
+            self.s3_client.upload_file(self.local_state_file_location, self.s3_bucket_name, self.s3_state_file_location)
+            return
 
-        nodes = self.list_nodes()
-        if n > len(nodes):
-            n = len(nodes)
+        logger.info('No local states either, building them from the running nodes')
+        self.INITIALIZING = True
+        try:
+            new_states = {}
+            node_states = self.dump_state()
+            new_states['node'] = node_states
+
+            container_states = {}
+            for name in node_states:
+                container_states[name] = {}
+                container_states[name]['status'] = self.CONTAINER_RUNNING
+
+            new_states['container'] = container_states
+
+            if self.journal_enabled:
+                # Nodes still in the status the journal last saw them in keep their count
+                journal = self.journal.load()
+                for name, (status, count) in journal['nodes'].items():
+                    if node_states.get(name, {}).get('status') == status:
+                        node_states[name]['count'] = count
+                new_states['journal'] = journal
+            logger.debug('Initial states: %s', new_states)
+            self.state_store.initialize(new_states)
+        finally:
+            self.INITIALIZING = False
+
+
+    def _now(self):
+        # Node names carry their creation time
+        return datetime.now()
 
-        nodes.sort(key=calculate_key)
-        
-        return nodes[0:n]
+    def list_nodes(self):
+        # GCE only sends back instances named like ours, the ones in a shared project that are not
+        # never leave the API, nor do the nodes of other pools
+        nodes = self.gce.list_nodes(ex_filter=self.node_filter)
+
+        # Filter nodes that don't fit the datetime format, the regex can't tell a 13th month.
+        # Names are parsed once, the cache only keeps the names listed this time.
+        created_at = {}
+        owned = []
+        for n in nodes:
+            created = self._created_at.get(n.name, False)
+            if created is False:
+                try:
+                    created = datetime.strptime(n.name[-23:-4], self.format)
+                except ValueError:
+                    created = None
+            created_at[n.name] = created
+            if created is not None:
+                owned.append(n)
+        self._created_at = created_at
+
+        return owned
+
+    def get_snapshot(self):
+        # One list_nodes() call per tick, reused until something invalidates it
+        if self.snapshot is None or not self.snapshot.valid:
+            warming = ()
+            # States being bootstrapped are built from this very snapshot, none to read yet
+            if self.warm_pool_size and not self.INITIALIZING:
+                containers = self._load_states()['container']
+                warming = [name for name, state in containers.items() if state['status'] == GCEAdapter.CONTAINER_WARMING]
+            self.snapshot = FleetSnapshot(self.list_nodes(), self._created_at, warming)
+            # Ephemeral ips get recycled, tie host keys to the instance currently behind each ip
+            for entry in self.snapshot:
+                if entry.ip:
+                    self.host_key_store.bind(entry.ip, entry.node.id)
+        return self.snapshot
+
+    def invalidate_snapshot(self):
+        if self.snapshot is not None:
+            self.snapshot.invalidate()
+
+    def state_lease(self):
+        # Held for the duration of a tick so overlapping controllers don't act on the same fleet
+        return self.state_store.lease(self.state_lease_ttl)
+
+    def begin_tick(self):
+        # Long running controllers keep the driver, ssh pool and state cache, but not the fleet view
+        self.invalidate_snapshot()
+        if self.state_store.loaded:
+            self.state_store.refresh()
+        super().begin_tick()
+
+    def end_tick(self):
+        if self.journal_enabled and self.state_store.loaded and self._load_states().get('journal'):
+            index = self._load_states()['journal']
+            try:
+                self.journal.flush(index)
+            except ClientError as e:
+                # The lines stay pending in the states, the next tick tries again
+                logger.warning('Could not write the journal to S3: %s', e)
+            self._store_states(index, 'journal')
+
+        # Everything this tick changed goes to S3 in one upload
+        self.state_store.flush()
+
+        counts = self.gce_client.tick_counts()
+        logger.info('%s GCE calls, %s retried, %s shared, %.1fs rate limited', counts.requests, counts.retries,
+                    counts.coalesced, counts.throttled)
+        self.metrics.set('gce_requests_last_tick', counts.requests)
+        self.metrics.set('gce_throttled_seconds_last_tick', counts.throttled)
+        super().end_tick()
+
+    def close(self):
+        # Let warm pool nodes still being created finish, their names are already in the states
+        if self._refill_executor is not None:
+            self._refill_executor.shutdown(wait=True)
+            self._refill_executor = None
+        if self.heartbeat_server is not None:
+            self.heartbeat_server.stop()
+            self.heartbeat_server = None
+        super().close()
+
+    def start_heartbeat_server(self):
+        from Heartbeats import HeartbeatServer
+
+        self.heartbeat_server = HeartbeatServer(self.heartbeats, self.heartbeat_port, self.heartbeat_address,
+                                                self.heartbeat_token).start()
+        return self.heartbeat_server
+
+    def _get_oldest_nodes(self, n, snapshot=None):
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        return snapshot.oldest(n)
+
+    def _select_victims(self, n, snapshot):
+        # Ranked by what this tick saw of the nodes, see select_victims
+        node_states = self._load_states()['node']
+        containers = self._load_states()['container']
+        candidates = []
+        for entry in snapshot:
+            state = node_states.get(entry.name) or {}
+            candidates.append(Candidate(entry.name, state.get('status', GCEAdapter.NODE_UNKNOWN), state.get('count', 0),
+                                        containers.get(entry.name, {}).get('status'), entry.created))
+        victims = select_victims(candidates, n, self._now(), self.billing_seconds)
+        if len(victims) < n:
+            logger.info('Only %s nodes can be spun down, the others are still starting.', len(victims))
+        return victims
 
     def _load_states(self):
-        states = {}
-
-        self.s3_client.download_file(self.s3_bucket_name, self.s3_state_file_location, self.local_state_file_location)
-        with open(self.local_state_file_location, 'r+') as state_file:
-            states = json.load(state_file)
-
-        return states
+        if not self.state_store.loaded:
+            try:
+                self.state_store.load()
+            except ClientError:
+                self._bootstrap_states()
+        return self.state_store.load()
 
     def _store_states(self, new_states, option):
-        states = self._load_states()
-        states[option] = new_states 
-
-        with open(self.local_state_file_location, 'w+') as state_file:
-            json.dump(states, state_file)        
-
-        self.s3_client.upload_file(self.local_state_file_location, self.s3_bucket_name, self.s3_state_file_location)
+        # Only updates the cached copy, end_tick() uploads it
+        self.state_store.set(option, new_states)
 
     def _set_container_state(self, node_name, state):
         states = self._load_states()['container']
@@ -176,6 +422,12 @@ class GCEAdapter(ElasticCloudAdapter):
             states[node_name]['status'] = state
         self._store_states(states, 'container')
 
+    def _set_container_states(self, node_names, state):
+        states = self._load_states()['container']
+        for node_name in node_names:
+            states.setdefault(node_name, {})['status'] = state
+        self._store_states(states, 'container')
+
     def _get_container_state(self, node_name):
         states = self._load_states()['container']
         state = states.get(node_name)
@@ -194,33 +446,46 @@ class GCEAdapter(ElasticCloudAdapter):
 
         self._store_states(stored_states, 'container')
 
-    def _update_container_state(self, node_name):
-        ip = self.get_node_ip(node_name)
-        if not ip:
-            return
-            
-        command = 'sudo docker ps'
-        container_running = 1
-        try:
-            (stdin, stdout, stderr) = self._run_ssh_command(ip, command)
-        except timeout:
-            print('ssh timed out')
-            return
+    def _update_container_states(self, node_names, snapshot=None, restart=True):
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        probes = self.probe_nodes(snapshot)
 
-        out = stdout.readlines()
-        print(out)
-        container_running = len(out) - 1
+        restarts = {}
+        time_now = self._now().timestamp()
+        for node_name in node_names:
+            if node_name not in probes:
+                continue
+            if probes[node_name] is None:
+                logger.warning('%s container state unknown, probe failed.', node_name)
+                continue
 
-        if container_running:
-            self._set_container_state(node_name, GCEAdapter.CONTAINER_RUNNING)
-        else:
-            print(node_name + ' container not currently running.')
+            logger.debug('%s compute_worker: %s', node_name, probes[node_name].worker)
+            if probes[node_name].worker == 'running':
+                state = self._load_states()['container'].get(node_name, {})
+                if state.get('status') == GCEAdapter.CONTAINER_STARTING and state.get('created_at'):
+                    state['running_at'] = time_now
+                    self._record_boot(time_now - state['created_at'], state.get('from_pool'))
+                self._set_container_state(node_name, GCEAdapter.CONTAINER_RUNNING)
+                self._load_states()['container'][node_name].pop('from_pool', None)
+            else:
+                logger.info('%s container not currently running.', node_name)
+                if self._load_states()['container'].get(node_name, {}).get('from_pool'):
+                    restarts[node_name] = (snapshot.ip(node_name), 'sudo docker start compute_worker')
+
+        # Warm pool nodes come back with compute_worker stopped, it was stopped before they were parked
+        if restarts and restart:
+            logger.info('Starting compute_worker on %s nodes taken from the warm pool', len(restarts))
+            self.probe_engine.run(restarts)
     
-    def update_all_states(self):
-        node_names = self.get_node_names()
+    def update_all_states(self, snapshot=None, restart=True):
+        # Without restart, compute_worker is not started on warm pool nodes and nodes are only probed
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        node_names = self.get_node_names(snapshot)
 
         old_node_states = self._load_states()['node']
-        new_node_states = self.dump_state()
+        new_node_states = self.dump_state(snapshot)
 
         node_states = {}
         for name in new_node_states:
@@ -233,215 +498,647 @@ class GCEAdapter(ElasticCloudAdapter):
                 node_states[name]['count'] = 1
         self._store_states(node_states, 'node')
 
-        for name in node_names:
-            self._update_container_state(name)
+        # Lifecycle of starting nodes: created_at, reachable_at once they answer, then running_at
+        containers = self._load_states()['container']
+        time_now = self._now().timestamp()
+        for name, state in new_node_states.items():
+            container = containers.get(name)
+            if state['status'] != GCEAdapter.NODE_UNKNOWN and container and container['status'] == GCEAdapter.CONTAINER_STARTING:
+                container.setdefault('reachable_at', time_now)
+        self._store_states(containers, 'container')
 
+        self._update_container_states(node_names, snapshot, restart)
 
-    def _wait_for_node_container_shutdown(self, node_name):
-        print("node_name:", node_name) # DEBUG
 
-        ip = self.get_node_ip(node_name)
-        if not ip:
-            return
+    def _drain_nodes(self, nodes, snapshot):
+        """
+        Stops compute_worker on all nodes at once and waits for the containers to exit, sharing
+        one drain_deadline between all of them. Returns (drained nodes, straggling nodes).
+        """
+        deadline = time.time() + self.drain_deadline
 
-        command = 'sudo docker ps'
-        container_running = 1
-        while container_running:
-            try:
-                (stdin, stdout, stderr) = self._run_ssh_command(ip, command)
-            except timeout:
-                print('ssh timed out')
-                return
-
-            out = stdout.readlines()
-            container_running = len(out) - 1
-            #print("container_running:", container_running) # DEBUG
-            if container_running:
-                print('container stopping.')
+        probes = {}
+        drained = []
+        for node in nodes:
+            ip = self.get_node_ip(node.name, snapshot)
+            if ip:
+                # Send SIGTERM to worker (docker stop)
+                probes[node.name] = (ip, 'sudo docker stop -t 10 compute_worker')
             else:
-                print('container stopped.')
-            time.sleep(0.5)
+                drained.append(node.name)
 
-    def _stop_container(self, node_name, container_name):
-        ip = self.get_node_ip(node_name)
-        if not ip:
-            return
+        results = self.probe_engine.run(probes, deadline=self.drain_deadline)
 
-        command = 'sudo docker stop -t 10 ' + container_name
+        pending = []
+        for name, out in results.items():
+            if out is None:
+                # Like before, a node we cannot reach is not waited on
+                logger.warning('Could not stop container on %s, destroying it anyway', name)
+                drained.append(name)
+            else:
+                pending.append(name)
 
-        try:
-            (stdin, stdout, stderr) = self._run_ssh_command(ip, command)
-        except timeout:
-            print('ssh timed out')
-            return
+        while pending and time.time() < deadline:
+            probes = {name: (self.get_node_ip(name, snapshot), 'sudo docker ps') for name in pending}
+            results = self.probe_engine.run(probes, deadline=max(0, deadline - time.time()))
 
-    def get_node_quantity(self):
-        return len(self.list_nodes())
+            pending = []
+            for name, out in results.items():
+                if out is not None and len(out) - 1 == 0:
+                    logger.info('%s container stopped.', name)
+                    drained.append(name)
+                else:
+                    pending.append(name)
 
-    def get_node_names(self):
-        nodes = self.list_nodes()
-        names = []
-        for n in nodes:
-            names.append(n.name)
-        return names
+            if pending:
+                time.sleep(min(1, max(0, deadline - time.time())))
 
-    def get_node_ip(self, node_name):
-        node = None
-        for n in self.list_nodes():
-            if n.name == node_name:
-                node = n
+        return ([node for node in nodes if node.name in drained],
+                [node for node in nodes if node.name not in drained])
 
-        ip = node.public_ips[0]
+    def get_node_quantity(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        return len(snapshot)
 
-        if not ip:
-            print('No external ip address for node {}'.format(node.name))
+    def get_node_names(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        return snapshot.names()
 
-        return ip
+    def get_node_ip(self, node_name, snapshot=None):
+        if snapshot is None:
+            snapshot = self.get_snapshot()
 
-    def expand(self, quantity):
-        current_quantity = self.get_node_quantity()
-        if current_quantity + quantity > self.max_nodes:
-            if current_quantity >= self.max_nodes:
-                print("Already " + str(self.get_node_quantity()) + " nodes running. (max)")
-            else: 
-                quantity = self.max_nodes - current_quantity
-                print("Already " + str(current_quantity) + " nodes running. (max)")
-                print("Only " + str(quantity) + " nodes will start up.")
+        ip = snapshot.ip(node_name)
 
-        now = datetime.now()
-        print('Creating new VM node...')
+        if not ip:
+            logger.warning('No external ip address for node %s', node_name)
 
-        new_node_arguments = {
+        return ip
+
+    def _run_concurrently(self, calls):
+        """
+        Runs calls, a dict of node name -> function taking a GCE driver, create_concurrency at a
+        time. Returns a dict of node name -> result, or the exception the call raised.
+        """
+        # libcloud drivers are not thread safe, every worker talks to GCE through its own driver
+        def run(call):
+            driver = getattr(self._worker_drivers, 'gce', None)
+            if driver is None:
+                driver = self._worker_drivers.gce = self.gce_client.wrap(self._new_gce_driver())
+            return call(driver)
+
+        results = {}
+        if not calls:
+            return results
+        with ThreadPoolExecutor(max_workers=min(self.create_concurrency, len(calls))) as executor:
+            futures = {}
+            for name, call in calls.items():
+                futures[executor.submit(run, call)] = name
+
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    results[name] = e
+        return results
+
+    def _create_nodes(self, names, arguments):
+        return self._run_concurrently({
+            name: lambda driver, name=name: driver.create_node(name=name, **self._node_arguments(name, arguments))
+            for name in names})
+
+    def _node_arguments(self, name, arguments):
+        # Every node gets its own heartbeat credential, jobs reading the metadata of one node can
+        # not send heartbeats for the others
+        if self.probe_mode != 'heartbeat':
+            return arguments
+        metadata = dict(arguments.get('ex_metadata') or {})
+        metadata['elastic-cloud-heartbeat-token'] = node_token(self.heartbeat_token, name)
+        return dict(arguments, ex_metadata=metadata)
+
+    def _create_nodes_in_zones(self, names, arguments):
+        # Nodes a zone has no capacity or quota for are asked for in the next zone
+        results = {}
+        pending = names
+        for zone in self.zones:
+            zone_results = self._create_nodes(pending, dict(arguments, location=zone))
+            results.update(zone_results)
+            pending = [name for name in pending if is_capacity_error(zone_results[name])]
+            if not pending:
+                break
+            logger.warning('%s is out of capacity for %s nodes: %s', zone, len(pending), zone_results[pending[0]])
+        return results
+
+    def _start_nodes(self, nodes):
+        return self._run_concurrently({
+            node.name: lambda driver, node=node: driver.ex_start_node(node) for node in nodes})
+
+    def _stop_nodes(self, nodes):
+        return self._run_concurrently({
+            node.name: lambda driver, node=node: driver.ex_stop_node(node) for node in nodes})
+
+    def _new_node_arguments(self):
+        arguments = {
             "size": self.size,
             "image": self.image,
-            "location": self.datacenter,
+            "location": self.zones[0],
             "ex_service_accounts": [{'email': self.service_account_email, 'scopes': ['compute']}]
         }
 
-        new_nodes = None
         if self.use_gpus:
+            arguments["ex_on_host_maintenance"] = "TERMINATE"
+            arguments["ex_accelerator_count"] = self.accelerator_count
+            arguments["ex_accelerator_type"] = self.accelerator_type
+
+        if self.probe_mode == 'heartbeat':
+            # The sidecar installs itself from here on boot, see scripts/GCE_Heartbeat_Sidecar.sh
+            with open(self.heartbeat_sidecar) as f:
+                sidecar = f.read()
+            arguments["ex_metadata"] = {
+                'startup-script': HEARTBEAT_INSTALL,
+                'elastic-cloud-heartbeat-script': sidecar,
+                'elastic-cloud-heartbeat-url': self.heartbeat_url,
+                'elastic-cloud-probe': PROBE_COMMAND,
+            }
+        return self._new_node_prefix(), arguments
+
+    def _new_node_prefix(self):
+        prefix = 'gpu-' if self.use_gpus else 'cpu-'
+        if self.pool is not None and self.pool != DEFAULT_POOL:
+            prefix += self.pool + '-'
+        return prefix
+
+    def _new_node_names(self, prefix, quantity):
+        # expand and refill_warm_pool may both create nodes within the same second, keep numbering
+        stamp = self._now().strftime(self.format)
+        if stamp != self._last_name_stamp:
+            self._last_name_stamp = stamp
+            self._name_sequence = 0
+        start = self._name_sequence
+        self._name_sequence += quantity
+        return [prefix + stamp + "-{:03d}".format(i) for i in range(start, start + quantity)]
+
+    def _start_warm_nodes(self, names, snapshot):
+        warm = [node for node in snapshot.warm() if node.name in names]
+        if not warm:
+            return []
+
+        logger.info('Starting %s VMs from the warm pool...', len(warm))
+        results = self._start_nodes(warm)
+
+        started = []
+        for node in warm:
+            result = results[node.name]
+            if isinstance(result, Exception):
+                logger.error('GCE Error starting %s: %s', node.name, result)
+                continue
+            started.append(node.name)
+        self.metrics.inc('nodes_started_total', len(started))
 
-            print("(note, we doing GPU stuff hoss)")
-            new_node_arguments["ex_on_host_maintenance"] = "TERMINATE"
-            new_node_arguments["ex_accelerator_count"] = 1
-            new_node_arguments["ex_accelerator_type"] = "nvidia-tesla-p100"
-             
-            for i in range(quantity):
-                base_name = 'gpu-' + now.strftime(self.format) + "-{:03d}".format(i)
-                new_node_arguments['name'] = base_name
-                new_node = None
-                try:
-                    new_node = self.gce.create_node(**new_node_arguments)
-                except GoogleBaseError as e:
-                    print('GCE Error:', e)
+        # compute_worker is started again by _update_container_states once the node answers
+        states = self._load_states()['container']
+        created_at = self._now().timestamp()
+        for name in started:
+            states[name] = {'status': GCEAdapter.CONTAINER_STARTING, 'from_pool': True, 'created_at': created_at}
+        self._store_states(states, 'container')
+        return started
 
-                if new_node:
-                    ip = new_node.public_ips[0]
-                    print("New GPU node running at " + ip + " with name " + new_node.name)
-                    # Mark container state as "STARTING"
-                    self._set_container_state(new_node.name, GCEAdapter.CONTAINER_STARTING)
+    def _plan_expand(self, quantity, snapshot):
+        # (warm pool nodes to start, names of nodes to create), bounded by max_nodes
+        current_quantity = self.get_node_quantity(snapshot)
+        if current_quantity + quantity > self.max_nodes:
+            quantity = self.max_nodes - current_quantity
+            logger.info("Already %s nodes running. (max)", current_quantity)
+            logger.info("Only %s nodes will start up.", max(0, quantity))
+        if quantity <= 0:
+            return (), ()
+
+        # Starting a stopped node skips the image boot and the worker image pull
+        start = tuple(node.name for node in snapshot.warm()[:quantity])
+        create = ()
+        if quantity > len(start):
+            create = tuple(self._new_node_names(self._new_node_prefix(), quantity - len(start)))
+        return start, create
+
+    def _plan_shrink(self, quantity, snapshot):
+        # Names of the nodes to let go of, bounded by min_nodes
+        current_quantity = self.get_node_quantity(snapshot)
+        if current_quantity - quantity < self.min_nodes:
+            quantity = current_quantity - self.min_nodes
+            logger.info('Spinning down %s nodes.', max(0, quantity))
+        if quantity <= 0:
+            return ()
+        return tuple(self._select_victims(quantity, snapshot))
+
+    def expand(self, quantity, snapshot=None):
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        current_quantity = self.get_node_quantity(snapshot)
+        if current_quantity >= self.max_nodes:
+            return "Already " + str(current_quantity) + " nodes running. (max)"
+
+        start, create = self._plan_expand(quantity, snapshot)
+        if not start and not create:
+            return "No nodes to create."
+        return self._expand_nodes(start, create, snapshot)
+
+    def _expand_nodes(self, start, create, snapshot):
+        started = self._start_warm_nodes(start, snapshot)
+        message = ''
+        if started:
+            message = "Started {} nodes from the warm pool. ".format(len(started))
+
+        prefix, new_node_arguments = self._new_node_arguments()
+        names = list(create)
+        if len(started) < len(start):
+            # Pool nodes that did not start are made up for with new ones
+            names += self._new_node_names(prefix, len(start) - len(started))
+        if not names:
+            snapshot.invalidate()
+            self.invalidate_snapshot()
+            return message.strip()
+
+        logger.info('Creating %s new VM nodes...', len(names))
+
+        # All inserts are submitted at once, so scaling out takes one operation wait per zone tried
+        results = self._create_nodes_in_zones(names, new_node_arguments)
+
+        created = []
+        for name in names:
+            new_node = results[name]
+            if isinstance(new_node, Exception):
+                logger.error('GCE Error creating %s: %s', name, new_node)
+                continue
 
-        else:
-            for i in range(quantity):
-                base_name = 'cpu-' + now.strftime(self.format) + "-{:03d}".format(i)
-                new_node_arguments['name'] = base_name
-                new_node = None
-                try:
-                    new_node = self.gce.create_node(**new_node_arguments)
-                except GoogleBaseError as e:
-                    print('GCE Error:', e)
-
-                if new_node:
-                    ip = new_node.public_ips[0]
-                    print("New CPU node running at " + ip + " with name " + new_node.name)
-                    # Mark container state as "STARTING"
-                    self._set_container_state(new_node.name, GCEAdapter.CONTAINER_STARTING)
-
-
-    def shrink(self, quantity):
-        current_quantity = self.get_node_quantity()
-        if current_quantity > self.min_nodes:
-            if current_quantity - quantity < self.min_nodes:
-                quantity = current_quantity - self.min_nodes
-                print('Spinning down {} nodes.'.format(quantity))
-        else:
+            ip = new_node.public_ips[0] if new_node.public_ips else None
+            logger.info("New %s node running at %s with name %s", prefix[:3].upper(), ip, new_node.name)
+            created.append(new_node.name)
+        self.metrics.inc('nodes_created_total', len(created))
+
+        # Mark container state as "STARTING", boot times are measured from here
+        states = self._load_states()['container']
+        created_at = self._now().timestamp()
+        for name in created:
+            states[name] = {'status': GCEAdapter.CONTAINER_STARTING, 'created_at': created_at}
+        self._store_states(states, 'container')
+
+        # The fleet changed, next lookup has to list nodes again
+        snapshot.invalidate()
+        self.invalidate_snapshot()
+
+        failed = [name for name in names if name not in created]
+        if failed:
+            return message + "Created {} of {} nodes, failed: {}".format(len(created), len(names), ', '.join(failed))
+        return message + "Created {} nodes.".format(len(created))
+
+
+    def shrink(self, quantity, snapshot=None):
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        if self.get_node_quantity(snapshot) <= self.min_nodes:
             return "Only " + str(self.min_nodes) + " nodes running. (min)"
-            
-            # get n oldest nodes
-        nodes = self._get_oldest_nodes(quantity)
 
+        return self._shrink_nodes(self._plan_shrink(quantity, snapshot), snapshot)
+
+    def _shrink_nodes(self, names, snapshot):
+        # Nodes gone since the plan was made are left out
+        nodes = [snapshot.get(name).node for name in names if name in snapshot]
+
+        # Mark state to "STOPPING"
+        self._set_container_states([node.name for node in nodes], GCEAdapter.CONTAINER_STOPPING)
+        states = self._load_states()['container']
+        stopping_at = self._now().timestamp()
         for node in nodes:
-            # Mark state to "STOPPING"
-            self._set_container_state(node.name, GCEAdapter.CONTAINER_STOPPING)
+            states[node.name].setdefault('stopping_at', stopping_at)
 
-            # Send SIGTERM to worker (docker stop)
-            self._stop_container(node.name, 'compute_worker')
+        drained, stragglers = self._drain_nodes(nodes, snapshot)
 
+        parked = []
+        if drained and self.stop_on_shrink:
+            parked = self._park_nodes(drained, snapshot)
+        destroyed = [node for node in drained if node.name not in parked]
 
-        print('Shutting down {} VMs...'.format(quantity))
-        self.gce.ex_destroy_multiple_nodes(nodes)
-        print('VMs have shut down.')
+        if destroyed:
+            logger.info('Shutting down %s VMs...', len(destroyed))
+            self.gce.ex_destroy_multiple_nodes(destroyed)
+            logger.info('VMs have shut down.')
+            self.metrics.inc('nodes_destroyed_total', len(destroyed))
 
-        for node in nodes:
             # Mark state to "STOPPED"
-            self._set_container_state(node.name, GCEAdapter.CONTAINER_STOPPED)
+            self._set_container_states([node.name for node in destroyed], GCEAdapter.CONTAINER_STOPPED)
+
+        if drained:
+            # The fleet changed, next lookup has to list nodes again
+            snapshot.invalidate()
+            self.invalidate_snapshot()
+
+        message = ''
+        if parked:
+            message = "Stopped {} nodes into the warm pool. ".format(len(parked))
+        if stragglers:
+            # Left in STOPPING, a later shrink picks them up again once their containers exited
+            return message + "Destroyed {} of {} nodes, still draining: {}".format(
+                len(destroyed), len(nodes) - len(parked), ', '.join(node.name for node in stragglers))
+        return message + "Destroyed {} nodes.".format(len(destroyed))
+
+    def plan(self, snapshot=None):
+        """
+        Decides what the tick does from one snapshot, without doing anything: the decision of
+        get_next_action, the exact nodes to start, create and destroy for it and the states it
+        changes. The cached states are left as they were, apply() stores the plan's.
+        """
+        if snapshot is None:
+            snapshot = self.get_snapshot()
 
+        start, create, destroy = (), (), ()
+        self._load_states()
+        version = self.state_store.version
+        checkpoint = self.state_store.checkpoint()
+        try:
+            action, count = self.get_next_action(snapshot)
+            states = self.state_store.changes(checkpoint)
+            journal = self._journal_entry(*self.last_observation) if self.journal_enabled else None
+            # Victims are ranked by the node states as of this decision
+            if action == ElasticCloudAdapter.ACTION_EXPAND:
+                start, create = self._plan_expand(count, snapshot)
+            elif action == ElasticCloudAdapter.ACTION_SHRINK:
+                destroy = self._plan_shrink(count, snapshot)
+        finally:
+            self.state_store.rollback(checkpoint)
+        return ScalingPlan(action, count, start, create, destroy, states, version, journal)
+
+    def apply(self, plan, snapshot=None):
+        """
+        Stores the states of a plan, journals its decision and carries out its action. Returns a
+        message, or None. Plans made from states that changed since are refused, their states
+        would overwrite the newer ones.
+        """
+        self._load_states()
+        if plan.version != self.state_store.version:
+            raise StalePlanError('The states changed since the plan was made, make a new one')
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        for section, value in plan.states.items():
+            self._store_states(copy.deepcopy(value), section)
+        if plan.journal and self.journal_enabled:
+            index = self._load_states().get('journal') or new_index()
+            self.journal.record(index, plan.journal['t'], plan.journal['nodes'], plan.journal['load'], plan.action,
+                                plan.count)
+            self._store_states(index, 'journal')
+
+        if plan.action == ElasticCloudAdapter.ACTION_EXPAND:
+            if not plan.start and not plan.create:
+                return "Already " + str(self.get_node_quantity(snapshot)) + " nodes running. (max)"
+            return self._expand_nodes(plan.start, plan.create, snapshot)
+        if plan.action == ElasticCloudAdapter.ACTION_SHRINK:
+            if not plan.destroy:
+                return "Only " + str(self.min_nodes) + " nodes running. (min)"
+            return self._shrink_nodes(plan.destroy, snapshot)
+        return None
+
+    def _park_nodes(self, nodes, snapshot):
+        # Drained nodes are stopped rather than destroyed while the warm pool has room for them
+        with self._refill_lock:
+            refilling = len(self._refilling)
+        room = self.warm_pool_size - len(snapshot.pool_names()) - refilling
+        nodes = nodes[:max(0, room)]
+        if not nodes:
+            return []
+
+        logger.info('Stopping %s VMs into the warm pool...', len(nodes))
+        results = self._stop_nodes(nodes)
+
+        parked = []
+        for node in nodes:
+            result = results[node.name]
+            if isinstance(result, Exception):
+                logger.error('GCE Error stopping %s, destroying it instead: %s', node.name, result)
+                continue
+            parked.append(node.name)
+        self.metrics.inc('nodes_stopped_total', len(parked))
+        self._set_container_states(parked, GCEAdapter.CONTAINER_WARM)
+        return parked
 
-    def dump_state(self):
-        node_states = {}
-        nodes = self.list_nodes()
-        print(nodes) # DEBUG
+    def refill_warm_pool(self, snapshot=None):
+        """
+        Keeps warm_pool_size stopped nodes around for expand() to start. New pool nodes are created
+        in the background with a startup script that pulls the worker image and powers them off,
+        so the tick does not wait for them. Returns a message, or None when there is no pool.
+        """
+        if not self.warm_pool_size:
+            return None
+        if snapshot is None or not snapshot.valid:
+            snapshot = self.get_snapshot()
+
+        pool = snapshot.pool_names()
+        with self._refill_lock:
+            refilling = set(self._refilling)
+
+        # Pool nodes that failed to come up or were deleted by hand leave their state behind
+        containers = self._load_states()['container']
+        for name, state in list(containers.items()):
+            if state['status'] not in (GCEAdapter.CONTAINER_WARMING, GCEAdapter.CONTAINER_WARM):
+                continue
+            if name not in pool and name not in snapshot and name not in refilling:
+                containers.pop(name)
+        for node in snapshot.warm():
+            if node.name in containers:
+                containers[node.name]['status'] = GCEAdapter.CONTAINER_WARM
+        self._store_states(containers, 'container')
+
+        size = len(pool) + len(refilling - set(pool))
+        self.metrics.set('warm_pool_nodes', size)
+
+        if size > self.warm_pool_size:
+            # Pool shrunk in the config, let go of the oldest stopped nodes
+            excess = snapshot.warm()[self.warm_pool_size - size:]
+            if not excess:
+                return None
+            logger.info('Destroying %s VMs from the warm pool...', len(excess))
+            self.gce.ex_destroy_multiple_nodes(excess)
+            self.metrics.inc('nodes_destroyed_total', len(excess))
+            self._set_container_states([node.name for node in excess], GCEAdapter.CONTAINER_STOPPED)
+            snapshot.invalidate()
+            self.invalidate_snapshot()
+            return "Destroyed {} nodes from the warm pool.".format(len(excess))
+
+        missing = self.warm_pool_size - size
+        if self.stop_on_shrink:
+            # Nodes above min go back into the pool when shrink lets go of them
+            missing -= max(0, len(snapshot) - self.min_nodes)
+        if missing <= 0:
+            return None
+
+        prefix, arguments = self._new_node_arguments()
+        with open(self.warm_pool_startup_script) as f:
+            startup_script = f.read()
+        arguments['ex_metadata'] = dict(arguments.get('ex_metadata') or {}, **{
+            'startup-script': startup_script, 'elastic-cloud-warm': 'true'})
+        names = self._new_node_names(prefix, missing)
+
+        # Marked before they exist so the next snapshot keeps them out of the running fleet
+        self._set_container_states(names, GCEAdapter.CONTAINER_WARMING)
+        self._submit_refill(names, arguments)
+        return "Warming up {} nodes for the warm pool.".format(missing)
+
+    def _submit_refill(self, names, arguments):
+        with self._refill_lock:
+            self._refilling.update(names)
+        if self._refill_executor is None:
+            self._refill_executor = ThreadPoolExecutor(max_workers=1)
+        self._refill_executor.submit(self._refill, names, arguments)
+
+    def _refill(self, names, arguments):
+        try:
+            results = self._create_nodes_in_zones(names, arguments)
+            created = 0
+            for name in names:
+                if isinstance(results[name], Exception):
+                    logger.error('GCE Error creating warm pool node %s: %s', name, results[name])
+                else:
+                    created += 1
+            self.metrics.inc('nodes_created_total', created)
+            logger.info('Created %s of %s warm pool nodes.', created, len(names))
+        finally:
+            with self._refill_lock:
+                self._refilling.difference_update(names)
 
-        # paramiko ssh
+
+    def probe_nodes(self, snapshot=None):
+        """
+        Runs PROBE_COMMAND on every node of the snapshot, all of them concurrently over paramiko
+        ssh. Returns node name -> NodeMetrics, or None for nodes that could not be probed. The
+        result is kept with the snapshot, everything that reads it during a tick shares one probe.
+
+        In heartbeat probe mode the nodes are not probed, their last heartbeat is used instead and
+        nodes without one in heartbeat_timeout seconds come back as None. Until the heartbeat
+        server has been up that long, nodes that did not send one yet are still probed over ssh.
+        """
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        if snapshot.probes is not None:
+            return snapshot.probes
+
+        nodes = snapshot.nodes()
+        snapshot.probes = {}
+        if self.probe_mode == 'heartbeat' and self.heartbeats.since is not None:
+            nodes = self._read_heartbeats(snapshot)
+        logger.debug('Probing %s', nodes)
+
+        probes = {}
         for node in nodes:
-            host = node.public_ips[0]
+            host = snapshot.ip(node.name)
             if not host:
-                print('No external ip address for node {}'.format(node.name))
+                logger.warning('No external ip address for node %s', node.name)
                 continue
 
-            print('{} : {}'.format(node.name, host)) # DEBUG
-            try:
-                self._connect(host)
-            except (timeout, ssh_exception.NoValidConnectionsError, ssh_exception.AuthenticationException):
-                print("ERROR :: Could not connect to host, maybe it is spinning down?")
+            logger.debug('%s : %s', node.name, host)
+            probes[node.name] = (host, PROBE_COMMAND)
+
+        results = self.probe_engine.run(probes)
+
+        for name, out in results.items():
+            snapshot.probes[name] = parse_probe(out) if out is not None else None
+        self._record_probes(snapshot.probes)
+        return snapshot.probes
+
+    def _read_heartbeats(self, snapshot):
+        # Fills snapshot.probes from the heartbeats, returns the nodes still to probe over ssh
+        self.heartbeats.forget(set(snapshot.names()) | set(snapshot.pool_names()), self.node_name_pattern)
+        warming_up = self._now().timestamp() - self.heartbeats.since < self.heartbeat_timeout
+
+        unprobed = []
+        for node in snapshot.nodes():
+            probe = self.heartbeats.get(node.name, self.heartbeat_timeout)
+            if probe is not None:
+                snapshot.probes[node.name] = probe
+            elif warming_up:
+                unprobed.append(node)
+            else:
+                logger.warning('No heartbeat from %s in the last %ss', node.name, self.heartbeat_timeout)
+                snapshot.probes[node.name] = None
+        return unprobed
+
+    def _record_probes(self, probes):
+        probed = [probe for probe in probes.values() if probe]
+        self.metrics.set('jobs_running', sum(probe.jobs for probe in probed))
+        disks = [probe.disk_free for probe in probed if probe.disk_free is not None]
+        if disks:
+            self.metrics.set('disk_free_bytes_min', min(disks))
+        gpus = [probe.gpu for probe in probed if probe.gpu is not None]
+        if gpus:
+            self.metrics.set('gpu_utilization', sum(gpus) / len(gpus))
+
+    def dump_state(self, snapshot=None):
+        node_states = {}
+        probes = self.probe_nodes(snapshot)
+
+        for name, probe in probes.items():
+            node_states[name] = { 'status': 'NOT-BUSY',
+                                  'count': 1,
+                                }
+            if probe is None:
+                logger.warning("Could not probe %s, maybe it is spinning up/down?", name)
+                node_states[name]['status'] = GCEAdapter.NODE_UNKNOWN
                 continue
 
-            commands = ['ls -la /tmp/codalab | wc -l']
-
-            for command in commands:
-                print('host:', host)
-                stdin, stdout, stderr = self.ssh_client.exec_command(command)
-                s = stdout.readlines()
-                if command == 'ls -la /tmp/codalab | wc -l':
-                    directory_length = int(s[0])
-                    node_states[node.name] = { 'status': 'NOT-BUSY',
-                                               'count': 1,
-                                             }
-                    if GCEAdapter.INITIALIZING:
-                        if directory_length > 4:
-                            node_states[node.name]['status'] = 'BUSY'
-                        else:
-                            node_states[node.name]['status'] = 'NOT-BUSY'
-                    else:
-                        if directory_length > 4:
-                            node_states[node.name]['status'] = 'BUSY'
-                        elif self._get_container_state(node.name) == GCEAdapter.CONTAINER_STARTING:
-                            node_states[node.name]['status'] = 'MANAGED'
-                        else:
-                            node_states[node.name]['status'] = 'NOT-BUSY'
+            if self.INITIALIZING:
+                if probe.jobs > 0:
+                    node_states[name]['status'] = 'BUSY'
                 else:
-                    for l in s:
-                        print(l)
-                    print("stderr", stderr.readlines())
+                    node_states[name]['status'] = 'NOT-BUSY'
+            else:
+                if probe.jobs > 0:
+                    node_states[name]['status'] = 'BUSY'
+                elif self._get_container_state(name) == GCEAdapter.CONTAINER_STARTING:
+                    node_states[name]['status'] = 'MANAGED'
+                else:
+                    node_states[name]['status'] = 'NOT-BUSY'
         return node_states
 
-    def get_next_action(self):
+    def _apply_load_reading(self, reading, idle_count, next_action, action_count):
+        # Track for how many ticks in a row jobs have been waiting in the queue
+        load = self._load_states().get('load') or {'pending': 0, 'count': 0}
+        if reading.pending > 0:
+            load['count'] = load['count'] + 1 if load['pending'] > 0 else 1
+        else:
+            load['count'] = 0
+        load['pending'] = reading.pending
+        self._store_states(load, 'load')
+
+        logger.info('broker: %s jobs waiting, %s consumers', reading.pending, reading.consumers)
+
+        if reading.pending == 0:
+            # An empty queue never justifies growing the fleet, the per-node counters decide shrinking
+            if next_action == ElasticCloudAdapter.ACTION_EXPAND:
+                return (ElasticCloudAdapter.ACTION_DO_NOTHING, 0)
+            return (next_action, action_count)
+
+        needed = math.ceil(reading.pending / self.jobs_per_node) - idle_count
+        if load['count'] >= self.EXPAND_CRITERION and needed > 0:
+            logger.info('expand criterion met, backlog needs %s more nodes', needed)
+            return (ElasticCloudAdapter.ACTION_EXPAND, needed)
+
+        # Jobs are waiting, idle nodes are about to pick them up
+        return (ElasticCloudAdapter.ACTION_DO_NOTHING, 0)
+
+    def get_next_action(self, snapshot=None):
         """
 
         If all nodes have been busy for longer than EXPAND_CRITERION, next action is expand.
         If there is a node that has been not-busy for longer than SHRINK_CRITERION, next action is shrink.
         Otherwise, next action is do-nothing.
 
+        With a broker load signal, jobs that have been waiting in the queue for EXPAND_CRITERION
+        ticks expand the fleet by as many nodes as the backlog needs, and nothing is shrunk while
+        jobs are waiting.
+
+        The result goes through scaling_policy, which keeps it (counter) or sizes the fleet by
+        utilization (target), and applies the cooldowns and the step bound.
+
         """
 
         next_action = ElasticCloudAdapter.ACTION_DO_NOTHING
@@ -449,20 +1146,28 @@ class GCEAdapter(ElasticCloudAdapter):
 
         
 
-        new_nodes = self.dump_state()
+        new_nodes = self.dump_state(snapshot)
         old_nodes = self._load_states()['node']
+        reading = self.load_signal.read()
         busy_count = 0
+        idle_count = 0
         managed_count = 0
+        unknown_count = 0
 
-        print('get_next_action:')
-        print('new_nodes:',new_nodes)
-        print('old_nodes:',old_nodes)
+        logger.debug('get_next_action: new_nodes: %s', new_nodes)
+        logger.debug('get_next_action: old_nodes: %s', old_nodes)
 
         for name in new_nodes:
             old_count = old_nodes[name]['count']
             old_state = old_nodes[name]['status']
             new_state = new_nodes[name]['status']
 
+            if new_state == GCEAdapter.NODE_UNKNOWN:
+                unknown_count += 1
+            elif new_state in ('NOT-BUSY', 'MANAGED'):
+                # Nodes that can still take a job, or will once they finished starting
+                idle_count += 1
+
             if old_state == new_state:
                 if new_nodes[name]['status'] == 'NOT-BUSY':
                     if old_count >= self.SHRINK_CRITERION:
@@ -477,18 +1182,92 @@ class GCEAdapter(ElasticCloudAdapter):
                 old_nodes[name]['count'] = 1
                 old_nodes[name]['status'] = new_state
 
-        # all nodes are in busy state
-        if busy_count == len(new_nodes):
+        # New nodes are unknown until they answer over ssh, they are on their way all the same
+        containers = self._load_states()['container']
+        booting = sum(1 for name, state in new_nodes.items() if state['status'] == GCEAdapter.NODE_UNKNOWN
+                      and containers.get(name, {}).get('status') == GCEAdapter.CONTAINER_STARTING)
+        unreachable = unknown_count - booting
+        if new_nodes and unreachable * 2 > len(new_nodes):
+            logger.warning('%s of %s nodes could not be probed, not scaling on their state', unreachable,
+                           len(new_nodes))
+
+        # all nodes are in busy state, nodes we could not probe don't count either way, booting
+        # nodes will take jobs soon. A fleet nobody could probe is not busy, it is unhealthy.
+        if (busy_count or not new_nodes) and busy_count == len(new_nodes) - unreachable:
             TOO_BUSY = True
             for name in old_nodes:
                 if old_nodes[name]['count'] < self.EXPAND_CRITERION:
                     TOO_BUSY = False
 
             if TOO_BUSY:
-                print('expand criterion met')
+                logger.info('expand criterion met')
                 next_action = ElasticCloudAdapter.ACTION_EXPAND
                 action_count = 1
 
+        if reading is not None:
+            next_action, action_count = self._apply_load_reading(reading, idle_count, next_action, action_count)
+
+        counts = Counter(state['status'] for state in new_nodes.values())
+        load = FleetLoad(len(new_nodes), counts['BUSY'], counts['NOT-BUSY'], counts['MANAGED'],
+                         counts[GCEAdapter.NODE_UNKNOWN], booting, reading.pending if reading else None,
+                         self.jobs_per_node, self._expected_boot_seconds(snapshot), self.probe_nodes(snapshot))
+        policy_state = self._load_states().get('policy') or {}
+        next_action, action_count = self.scaling_policy.decide(load, (next_action, action_count), policy_state,
+                                                               self._now().timestamp())
+        self._store_states(policy_state, 'policy')
+
+        # What the decision was made on, plan() journals it
+        self.last_observation = (new_nodes, load)
+
         self._store_states(old_nodes, 'node')
         self._clean_container_states()
+
+        self._record_fleet(new_nodes)
+        self.metrics.inc('decisions_total', action=next_action)
         return (next_action, action_count)
+
+    def _journal_entry(self, node_states, load):
+        # Probes are summed up, the node statuses already tell about every node
+        summary = load._asdict()
+        probes = summary.pop('probes') or {}
+        summary['jobs'] = sum(probe.jobs for probe in probes.values() if probe)
+        return {'t': self._now().timestamp(), 'nodes': {name: state['status'] for name, state in node_states.items()},
+                'load': summary}
+
+    def _node_kind(self, from_pool=False):
+        # Boot times are kept apart for every kind of node, see BootStats
+        kind = '{}-{}'.format('gpu' if self.use_gpus else 'cpu', self.size)
+        return kind + '-warm' if from_pool else kind
+
+    def _boot_stats(self):
+        return BootStats(self._load_states().get('boot') or {})
+
+    def _record_boot(self, seconds, from_pool=False):
+        kind = self._node_kind(from_pool)
+        boot_stats = self._boot_stats()
+        boot_stats.add(kind, seconds)
+        self._store_states(boot_stats.samples, 'boot')
+
+        summary = boot_stats.summary(kind)
+        logger.info('%s node booted in %.0fs, median %.0fs, p90 %.0fs over %s boots',
+                    kind, seconds, summary.median, summary.p90, summary.count)
+        self.metrics.observe('boot_seconds', seconds, kind=kind)
+        self.metrics.set('boot_seconds_p90', summary.p90, kind=kind)
+
+    def _expected_boot_seconds(self, snapshot=None):
+        # Nodes come from the warm pool first, slow boots are what scaling out has to plan for
+        boot_stats = self._boot_stats()
+        cold = boot_stats.summary(self._node_kind())
+        warm = boot_stats.summary(self._node_kind(True))
+        if warm and (cold is None or (snapshot or self.get_snapshot()).warm()):
+            return warm.p90
+        return cold.p90 if cold else 0
+
+    def _record_fleet(self, node_states):
+        counts = Counter(state['status'] for state in node_states.values())
+        for status in ('BUSY', 'NOT-BUSY', 'MANAGED', GCEAdapter.NODE_UNKNOWN):
+            self.metrics.set('nodes', counts[status], state=status.lower())
+
+        containers = self._load_states()['container']
+        starting = sum(1 for state in containers.values() if state['status'] == GCEAdapter.CONTAINER_STARTING)
+        self.metrics.set('nodes', starting, state='starting')
@@ -0,0 +1,184 @@
+import logging
+import random
+import threading
+import time
+from collections import Counter, namedtuple
+
+
+logger = logging.getLogger(__name__)
+
+# GCE error codes of requests turned away for going over the per-project request rate
+RATE_LIMIT_CODES = ('rateLimitExceeded', 'userRateLimitExceeded', 'RATE_LIMIT_EXCEEDED')
+
+# Driver calls that only read, safe to retry on server errors and to share between callers
+READ_PREFIXES = ('list_', 'ex_list_', 'ex_get_')
+
+# GCE calls of one tick: calls made, retries among them, reads answered by another caller's
+# call and seconds spent waiting on the rate limit
+TickCounts = namedtuple('TickCounts', ['requests', 'retries', 'coalesced', 'throttled'])
+
+
+def is_retryable(error, read=False):
+    """
+    Rate limited calls never did anything and are always retried. Server errors are retried for
+    reads only, a create that failed with a 503 may still have created the node.
+    """
+    # libcloud raises GoogleBaseError with http_code and a GCE code, or RateLimitReachedError
+    # with the http status in code
+    status = getattr(error, 'http_code', None)
+    code = getattr(error, 'code', None)
+    if status == 429 or code == 429 or code in RATE_LIMIT_CODES:
+        return True
+    return read and isinstance(status, int) and status >= 500
+
+
+class TokenBucket:
+    """
+    Lets rate calls a second through, and bursts of up to burst calls. Callers over the rate
+    reserve the next token and sleep until it is theirs, so waiting callers go in turn.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Returns the seconds the caller waited
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            self.sleep(wait)
+        return wait
+
+
+class GCEClient:
+    """
+    Rate limiting, retries and read coalescing for the GCE drivers of an adapter.
+
+    Every driver, one per thread as libcloud drivers are not thread safe, is wrapped by wrap() and
+    shares this client. Calls take a token from a bucket of rate calls a second, GCE counts
+    requests per project. Rate limited calls, and reads that hit a server error, are retried up to
+    max_retries times after an exponential backoff with full jitter. Identical reads made while
+    one is in flight wait for it and share its result.
+
+    A call is one token, whatever requests libcloud makes for it. rate 0 turns the limit off.
+    """
+
+    def __init__(self, rate=10, burst=20, max_retries=5, retry_delay=0.5, max_retry_delay=30, metrics=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.limiter = TokenBucket(rate, burst, clock, sleep) if rate else None
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.metrics = metrics
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._counts = Counter()
+        self._throttled = 0.0
+
+    def wrap(self, driver):
+        return GCEDriverProxy(self, driver)
+
+    def call(self, driver, name, args, kwargs):
+        if not name.startswith(READ_PREFIXES):
+            return self._call(driver, name, args, kwargs, False)
+
+        key = (name, repr(args), repr(sorted(kwargs.items())))
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self._counts['coalesced'] += 1
+        if not leader:
+            return flight.wait()
+
+        try:
+            flight.result = self._call(driver, name, args, kwargs, True)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _call(self, driver, name, args, kwargs, read):
+        attempt = 0
+        while True:
+            if self.limiter:
+                waited = self.limiter.acquire()
+                if waited:
+                    with self._lock:
+                        self._throttled += waited
+            with self._lock:
+                self._counts['requests'] += 1
+
+            try:
+                return getattr(driver, name)(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e, read):
+                    raise
+                delay = random.uniform(0, min(self.max_retry_delay, self.retry_delay * 2 ** attempt))
+                # GCE may say how long to back off for
+                delay = max(delay, getattr(e, 'retry_after', 0) or 0)
+                logger.warning('GCE %s failed, retry %s of %s in %.1fs: %s', name, attempt + 1, self.max_retries,
+                               delay, e)
+                attempt += 1
+                with self._lock:
+                    self._counts['retries'] += 1
+                if self.metrics:
+                    self.metrics.inc('gce_retries_total', call=name)
+                self.sleep(delay)
+
+    def tick_counts(self):
+        # Counts since the last call, once per tick
+        with self._lock:
+            counts = TickCounts(self._counts['requests'], self._counts['retries'], self._counts['coalesced'],
+                                self._throttled)
+            self._counts.clear()
+            self._throttled = 0.0
+        return counts
+
+
+class GCEDriverProxy:
+    """A GCE driver whose method calls go through a GCEClient."""
+
+    def __init__(self, client, driver):
+        self._client = client
+        self._driver = driver
+
+    def __getattr__(self, name):
+        attribute = getattr(self._driver, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            return self._client.call(self._driver, name, args, kwargs)
+        return call
+
+
+class _Flight:
+    # A read in flight, the callers waiting for it get its result or its error
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
@@ -0,0 +1,117 @@
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+
+from NodeMetrics import node_metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Heartbeats are a few hundred bytes, anything much larger is not one
+MAX_HEARTBEAT_BYTES = 64 * 1024
+
+
+def node_token(secret, name):
+    # Credential of one node, the heartbeats of other nodes can not be sent with it
+    return hmac.new(secret.encode('utf-8'), name.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+class HeartbeatStore:
+    """
+    Latest heartbeat of every worker, written by the HeartbeatServer threads and read by
+    probe_nodes. clock() gives the time heartbeats are received at and judged stale against.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        # When the HeartbeatServer feeding the store started, None while nothing receives heartbeats
+        self.since = None
+        self._lock = threading.Lock()
+        self._beats = {}
+
+    def record(self, name, probe):
+        with self._lock:
+            self._beats[name] = (self.clock(), probe)
+
+    def get(self, name, timeout):
+        # NodeMetrics of the last heartbeat, None if there was none in the last timeout seconds
+        with self._lock:
+            beat = self._beats.get(name)
+        if beat is None or self.clock() - beat[0] > timeout:
+            return None
+        return beat[1]
+
+    def forget(self, keep, pattern=None):
+        # Drops the heartbeats of nodes that are gone, only of names matching pattern when the
+        # store is shared by several pools
+        with self._lock:
+            for name in [name for name in self._beats if name not in keep]:
+                if pattern is None or pattern.fullmatch(name):
+                    del self._beats[name]
+
+
+class HeartbeatServer:
+    """
+    Receives the heartbeats workers push, POST /heartbeat with a json body of the node name and
+    the output of PROBE_COMMAND: {"name": "cpu-...", "probe": {"entries": 1, ...}}. Requests have
+    to carry the node_token of the node they are for, "Authorization: Bearer <node token>".
+    """
+
+    def __init__(self, store, port, address='0.0.0.0', token=None):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        if not token:
+            raise ValueError('Heartbeats are only received with a token to check them against')
+        self.store = store
+        heartbeat_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path.split('?')[0] != '/heartbeat':
+                    self.send_error(404)
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                if not 0 < length <= MAX_HEARTBEAT_BYTES:
+                    self.send_error(413 if length else 411)
+                    return
+                try:
+                    beat = json.loads(self.rfile.read(length).decode('utf-8'))
+                    name = str(beat['name'])
+                    probe = node_metrics(beat['probe'])
+                except (ValueError, TypeError, KeyError) as e:
+                    logger.warning('Bad heartbeat from %s: %s', self.client_address[0], e)
+                    self.send_error(400)
+                    return
+
+                authorization = self.headers.get('Authorization', '').encode('utf-8')
+                expected = 'Bearer {}'.format(node_token(token, name)).encode('utf-8')
+                if not hmac.compare_digest(authorization, expected):
+                    self.send_error(401)
+                    return
+
+                heartbeat_server.store.record(name, probe)
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        self.store.since = self.store.clock()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class HostKeyStore:
+    """
+    Process-wide ssh host key store keyed by ip address and GCE instance id.
+
+    GCE hands ephemeral ips out again after an instance is deleted, so a key is only trusted for the
+    instance that presented it. When an ip is bound to a new instance id the old key is forgotten
+    instead of being rejected, and ~/.ssh/known_hosts is never read or written. Keys can optionally
+    be persisted to a small json cache, which is written at most once per flush().
+    """
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        # (ip, instance id) -> [key type, base64 key]
+        self._keys = {}
+        # ip -> instance id currently holding that ip
+        self._instances = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path) as f:
+                cached = json.load(f)
+            for ip, instance_id, key_type, key in cached:
+                self._keys[(ip, instance_id)] = [key_type, key]
+                self._instances[ip] = instance_id
+
+    def bind(self, ip, instance_id):
+        with self._lock:
+            old_instance_id = self._instances.get(ip)
+            if old_instance_id == instance_id:
+                return
+            self._instances[ip] = instance_id
+            if self._keys.pop((ip, old_instance_id), None):
+                logger.info('%s was recycled by a new instance, forgetting its host key', ip)
+                self._dirty = True
+
+    def check(self, ip, key):
+        fingerprint = [key.get_name(), key.get_base64()]
+        with self._lock:
+            host_id = (ip, self._instances.get(ip))
+            known = self._keys.get(host_id)
+            if known is None:
+                self._keys[host_id] = fingerprint
+                self._dirty = True
+                return
+        if known != fingerprint:
+            from paramiko.ssh_exception import SSHException
+            raise SSHException('Host key for {} does not match the key seen earlier for this instance'.format(ip))
+
+    def policy(self):
+        return HostKeyStorePolicy(self)
+
+    def flush(self):
+        if not self.cache_path or not self._dirty:
+            return
+
+        with self._lock:
+            cached = [[ip, instance_id, key_type, key] for (ip, instance_id), (key_type, key) in self._keys.items()]
+            self._dirty = False
+
+        with open(self.cache_path, 'w') as f:
+            json.dump(cached, f)
+
+
+class HostKeyStorePolicy:
+    # Duck types paramiko.MissingHostKeyPolicy so paramiko is only imported once ssh is used
+    def __init__(self, store):
+        self.store = store
+
+    def missing_host_key(self, client, hostname, key):
+        self.store.check(hostname, key)
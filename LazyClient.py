@@ -0,0 +1,26 @@
+import threading
+
+
+class LazyClient:
+    """
+    Stands in for an SDK client until it is first used.
+
+    Building GCE and S3 clients means importing their SDKs and, for GCE, fetching an OAuth token.
+    Commands that never talk to a service should not pay for it.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
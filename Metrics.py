@@ -0,0 +1,230 @@
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+
+PREFIX = 'elastic_cloud_'
+
+HELP = {
+    'phase_seconds': 'Time spent in each phase of a tick.',
+    'external_calls_total': 'Calls made to GCE, S3 and the workers over ssh.',
+    'external_call_errors_total': 'Calls to GCE, S3 and the workers over ssh that raised.',
+    'external_call_seconds': 'Time spent waiting on GCE, S3 and the workers over ssh.',
+    'nodes': 'Nodes by state as of the last tick.',
+    'decisions_total': 'Scaling decisions taken by get_next_action.',
+    'nodes_created_total': 'Nodes created by expand.',
+    'nodes_destroyed_total': 'Nodes destroyed by shrink.',
+    'nodes_started_total': 'Nodes started from the warm pool.',
+    'nodes_stopped_total': 'Nodes stopped into the warm pool by shrink.',
+    'warm_pool_nodes': 'Nodes in the warm pool, stopped or being prepared.',
+    'ticks_total': 'Controller ticks run.',
+    'gce_retries_total': 'GCE calls retried after a rate limit or server error.',
+    'gce_requests_last_tick': 'GCE calls made during the last tick, retries included.',
+    'gce_throttled_seconds_last_tick': 'Time GCE calls waited on the request rate limit during the last tick.',
+    'boot_seconds': 'Time from asking GCE for a node until its compute_worker ran.',
+    'boot_seconds_p90': '90th percentile of the recent boot times.',
+}
+
+
+class _Recorder:
+    # Timings and call counts on top of inc() and observe(), the same for Metrics and LabelledMetrics
+    @contextmanager
+    def timer(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('phase_seconds', time.perf_counter() - started, phase=phase)
+
+    @contextmanager
+    def external_call(self, service, call):
+        self.inc('external_calls_total', service=service, call=call)
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc('external_call_errors_total', service=service, call=call)
+            raise
+        finally:
+            self.observe('external_call_seconds', time.perf_counter() - started, service=service)
+
+    def instrument(self, client, service):
+        return InstrumentedClient(client, self, service)
+
+
+class Metrics(_Recorder):
+    """
+    Counters, gauges and timings of the controller, rendered in the Prometheus text format.
+
+    Series are keyed by name and a sorted tuple of label pairs. Timings are kept as a sum and a
+    count, which is all a Prometheus summary without quantiles needs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            total, count = self.timings.get(key, (0.0, 0))
+            self.timings[key] = (total + seconds, count + 1)
+
+    def get(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self.timings:
+                return self.timings[key]
+            return self.counters.get(key, self.gauges.get(key))
+
+    def labelled(self, **labels):
+        # Same series, with labels added to every one of them, e.g. the pool a node belongs to
+        return LabelledMetrics(self, labels)
+
+    def render(self):
+        with self._lock:
+            series = [('counter', self.counters), ('gauge', self.gauges)]
+            lines = []
+            for kind, values in series:
+                self._render_series(lines, kind, values)
+
+            names = sorted(set(name for name, _ in self.timings))
+            for name in names:
+                self._render_header(lines, name, 'summary')
+                for (series_name, labels), (total, count) in sorted(self.timings.items()):
+                    if series_name == name:
+                        lines.append('{}{}_sum{} {}'.format(PREFIX, name, _labels(labels), total))
+                        lines.append('{}{}_count{} {}'.format(PREFIX, name, _labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        # node_exporter may read the file at any time, replace it in one rename
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.elastic_cloud_metrics')
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.render())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+    def _render_series(self, lines, kind, values):
+        names = sorted(set(name for name, _ in values))
+        for name in names:
+            self._render_header(lines, name, kind)
+            for (series_name, labels), value in sorted(values.items()):
+                if series_name == name:
+                    lines.append('{}{}{} {}'.format(PREFIX, name, _labels(labels), value))
+
+    def _render_header(self, lines, name, kind):
+        if name in HELP:
+            lines.append('# HELP {}{} {}'.format(PREFIX, name, HELP[name]))
+        lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = ['{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels]
+    return '{' + ','.join(pairs) + '}'
+
+
+class LabelledMetrics(_Recorder):
+    """Records into metrics with labels added to every series, renders everything metrics holds."""
+
+    def __init__(self, metrics, labels):
+        self.metrics = metrics
+        self.labels = labels
+
+    def inc(self, name, value=1, **labels):
+        self.metrics.inc(name, value, **dict(self.labels, **labels))
+
+    def set(self, name, value, **labels):
+        self.metrics.set(name, value, **dict(self.labels, **labels))
+
+    def observe(self, name, seconds, **labels):
+        self.metrics.observe(name, seconds, **dict(self.labels, **labels))
+
+    def get(self, name, **labels):
+        return self.metrics.get(name, **dict(self.labels, **labels))
+
+    def labelled(self, **labels):
+        return LabelledMetrics(self.metrics, dict(self.labels, **labels))
+
+    def render(self):
+        return self.metrics.render()
+
+    def write_textfile(self, path):
+        self.metrics.write_textfile(path)
+
+
+class InstrumentedClient:
+    """Counts and times every method called on a GCE driver or boto3 client."""
+
+    def __init__(self, client, metrics, service):
+        self._client = client
+        self._metrics = metrics
+        self._service = service
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            with self._metrics.external_call(self._service, name):
+                return attribute(*args, **kwargs)
+        return call
+
+
+class MetricsServer:
+    """Serves /metrics on a background thread, for Prometheus to scrape the daemon."""
+
+    def __init__(self, metrics, port, address='127.0.0.1'):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.metrics = metrics
+        metrics_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics_server.metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,41 @@
+import json
+import logging
+from collections import namedtuple
+
+
+logger = logging.getLogger(__name__)
+
+
+# What one probe tells about a node. jobs is the number of submissions compute_worker is running,
+# worker the docker status of the compute_worker container ('running', 'exited', ... or 'missing'),
+# load the 1 minute load average, disk_free the bytes free under /tmp/codalab and gpu the mean
+# utilization of the GPUs in percent, None on nodes without any.
+NodeMetrics = namedtuple('NodeMetrics', ['jobs', 'worker', 'load', 'disk_free', 'gpu'])
+
+# Everything is read in one ssh session and printed as a single line of json. /tmp/codalab holds
+# one entry of its own next to a directory per running submission.
+PROBE_COMMAND = (
+    "entries=$(ls -A /tmp/codalab 2>/dev/null | wc -l); "
+    "worker=$(sudo docker inspect --format '{{.State.Status}}' compute_worker 2>/dev/null || echo missing); "
+    "load=$(cut -d ' ' -f 1 /proc/loadavg); "
+    "disk=$(df -Pk /tmp/codalab 2>/dev/null | awk 'NR == 2 {print $4 * 1024}'); "
+    "gpu=$(nvidia-smi --query-gpu=utilization.gpu --format=csv,noheader,nounits 2>/dev/null"
+    " | awk '{total += $1; n++} END {if (n) print total / n}'); "
+    "printf '{\"entries\": %s, \"worker\": \"%s\", \"load\": %s, \"disk_free\": %s, \"gpu\": %s}\\n'"
+    " \"$entries\" \"$worker\" \"${load:-null}\" \"${disk:-null}\" \"${gpu:-null}\""
+)
+
+
+def parse_probe(lines):
+    """Turns the output of PROBE_COMMAND into NodeMetrics, None if it makes no sense."""
+    try:
+        return node_metrics(json.loads(''.join(lines)))
+    except (ValueError, TypeError, KeyError) as e:
+        logger.warning('Could not parse probe output %r: %s', lines, e)
+        return None
+
+
+def node_metrics(probe):
+    # probe is the json object PROBE_COMMAND prints, raises KeyError when entries or worker are missing
+    return NodeMetrics(max(0, int(probe['entries']) - 1), str(probe['worker']), probe.get('load'),
+                       probe.get('disk_free'), probe.get('gpu'))
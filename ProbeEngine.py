@@ -0,0 +1,75 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProbeEngine:
+    """
+    Runs one ssh command on many nodes at once.
+
+    Probes are fanned out over a bounded thread pool and collected against a single deadline, so a
+    tick takes as long as the slowest node instead of the sum of all of them. Nodes that fail or do
+    not answer before the deadline come back as None so callers can report them as UNKNOWN.
+    """
+
+    def __init__(self, run_command, concurrency=10, deadline=30):
+        # run_command(host, command) -> list of stdout lines, raising on failure
+        self.run_command = run_command
+        self.concurrency = concurrency
+        self.deadline = deadline
+
+    def run(self, probes, deadline=None):
+        """
+        probes maps node name -> (host, command); returns node name -> stdout lines or None
+        """
+        if not probes:
+            return {}
+
+        if deadline is None:
+            deadline = self.deadline
+
+        if self.concurrency <= 1:
+            return self._run_serial(probes, deadline)
+
+        results = {}
+        executor = ThreadPoolExecutor(max_workers=min(self.concurrency, len(probes)))
+        futures = {}
+        for name, (host, command) in probes.items():
+            futures[executor.submit(self.run_command, host, command)] = name
+
+        done, not_done = wait(futures, timeout=deadline)
+
+        for future in done:
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logger.warning('Probe failed on %s: %s', name, e)
+                results[name] = None
+
+        for future in not_done:
+            name = futures[future]
+            logger.warning('Probe on %s did not finish within %ss', name, deadline)
+            results[name] = None
+
+        # Don't wait on stuck probes, their ssh timeout will reap the threads
+        executor.shutdown(wait=False, cancel_futures=True)
+        return results
+
+    def _run_serial(self, probes, deadline):
+        results = {}
+        started = time.time()
+        for name, (host, command) in probes.items():
+            if time.time() - started > deadline:
+                logger.warning('Probe on %s skipped, tick deadline of %ss passed', name, deadline)
+                results[name] = None
+                continue
+            try:
+                results[name] = self.run_command(host, command)
+            except Exception as e:
+                logger.warning('Probe failed on %s: %s', name, e)
+                results[name] = None
+        return results
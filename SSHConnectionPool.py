@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class SSHConnectionPool:
+    """
+    Keeps one authenticated ssh client per host alive across commands and ticks.
+
+    Clients are handed out least-recently-used last; when the pool is full the least recently used
+    client is closed to make room. Clients whose transport died, or that sat unused for longer than
+    idle_timeout seconds, are dropped and reconnected on next use.
+    """
+
+    def __init__(self, connect, max_sessions=50, idle_timeout=300, keepalive_interval=30):
+        # connect(host) -> connected paramiko.SSHClient
+        self.connect = connect
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+
+        # host -> [client, last_used]
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self._host_locks = {}
+
+    def __len__(self):
+        return len(self._clients)
+
+    def get(self, host):
+        self.evict_idle()
+
+        client = self._checkout(host)
+        if client:
+            return client
+
+        # Only one handshake per host at a time, concurrent callers wait and share the result
+        with self._host_lock(host):
+            client = self._checkout(host)
+            if client:
+                return client
+
+            client = self.connect(host)
+            transport = client.get_transport()
+            if transport and self.keepalive_interval:
+                transport.set_keepalive(self.keepalive_interval)
+
+            evicted = []
+            with self._lock:
+                self._clients[host] = [client, time.time()]
+                while len(self._clients) > self.max_sessions:
+                    _, (old_client, _) = self._clients.popitem(last=False)
+                    evicted.append(old_client)
+
+            for old_client in evicted:
+                old_client.close()
+
+            return client
+
+    def discard(self, host):
+        with self._lock:
+            entry = self._clients.pop(host, None)
+        if entry:
+            entry[0].close()
+
+    def evict_idle(self):
+        now = time.time()
+        evicted = []
+        with self._lock:
+            # Clients are kept least recently used first, stop at the first one still in use
+            while self._clients:
+                host, (client, last_used) = next(iter(self._clients.items()))
+                if now - last_used <= self.idle_timeout:
+                    break
+                evicted.append(client)
+                del self._clients[host]
+
+        for client in evicted:
+            client.close()
+
+    def close_all(self):
+        with self._lock:
+            clients = [client for client, _ in self._clients.values()]
+            self._clients.clear()
+
+        for client in clients:
+            client.close()
+
+    def _checkout(self, host):
+        broken = None
+        with self._lock:
+            entry = self._clients.get(host)
+            if not entry:
+                return None
+
+            transport = entry[0].get_transport()
+            if transport and transport.is_active():
+                entry[1] = time.time()
+                self._clients.move_to_end(host)
+                return entry[0]
+
+            broken = self._clients.pop(host)[0]
+
+        logger.info('Dropping broken ssh connection to %s', host)
+        broken.close()
+        return None
+
+    def _host_lock(self, host):
+        with self._lock:
+            return self._host_locks.setdefault(host, threading.Lock())
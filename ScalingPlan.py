@@ -0,0 +1,25 @@
+import json
+from collections import namedtuple
+
+
+# What a tick is going to do, decided from one snapshot by plan() and carried out by apply().
+# start are the warm pool nodes to start, create the names of the nodes to create and destroy the
+# nodes to drain and let go of. states are the sections of the states the decision changed, as
+# apply() stores them. version is the version of the states the plan was made from, a plan is
+# only applied to those. journal is the journal line of the decision, None without a journal.
+ScalingPlan = namedtuple('ScalingPlan', ['action', 'count', 'start', 'create', 'destroy', 'states', 'version',
+                                         'journal'])
+
+
+class StalePlanError(Exception):
+    pass
+
+
+def plan_to_json(plan):
+    return json.dumps(plan._asdict(), sort_keys=True)
+
+
+def plan_from_json(text):
+    plan = json.loads(text)
+    return ScalingPlan(plan['action'], plan['count'], tuple(plan['start']), tuple(plan['create']),
+                       tuple(plan['destroy']), plan['states'], plan['version'], plan['journal'])
@@ -0,0 +1,176 @@
+import logging
+import math
+from collections import namedtuple
+
+from ElasticCloudAdapter import ElasticCloudAdapter
+
+
+logger = logging.getLogger(__name__)
+
+
+# What get_next_action saw this tick. Node counts exclude nodes being drained, starting nodes are
+# the MANAGED ones that will take jobs once compute_worker runs. booting are the unknown nodes that
+# were just created and do not answer over ssh yet. pending is the broker backlog,
+# None without a broker load signal. boot_seconds is how long a node asked for now is expected to
+# take until it runs jobs, see BootStats. probes maps node name -> NodeMetrics, None for nodes that
+# could not be probed.
+FleetLoad = namedtuple('FleetLoad', ['nodes', 'busy', 'idle', 'starting', 'unknown', 'booting', 'pending',
+                                     'jobs_per_node', 'boot_seconds', 'probes'])
+
+
+class ScalingPolicy:
+    """
+    Turns the load of the fleet into a scaling action.
+
+    decide() gets the action the per-node counters came up with, a policy may keep it or make its
+    own. Either way the result is bounded to max_step nodes and held back by the cooldowns:
+    scale_up_cooldown seconds between two expands, scale_down_cooldown seconds between any scaling
+    and a shrink. state is a dict kept in the 'policy' section of the states between ticks.
+
+    The demand of the last trend_window ticks is kept too. Extrapolating its trend over the boot
+    time tells how much demand there will be once nodes asked for now are up.
+    """
+
+    def __init__(self, max_step=None, scale_up_cooldown=0, scale_down_cooldown=0, trend_window=5):
+        self.max_step = max_step
+        self.scale_up_cooldown = scale_up_cooldown
+        self.scale_down_cooldown = scale_down_cooldown
+        self.trend_window = trend_window
+
+    def decide(self, load, counter_decision, state, now):
+        history = state.setdefault('history', [])
+        history.append([now, self.demand(load)])
+        del history[:-self.trend_window]
+
+        next_action, action_count = self._decide(load, counter_decision, state, now)
+
+        if next_action == ElasticCloudAdapter.ACTION_EXPAND:
+            waited = now - state.get('last_expand', float('-inf'))
+            if waited < self.scale_up_cooldown:
+                logger.info('expand held back, %.0fs left of the scale up cooldown', self.scale_up_cooldown - waited)
+                return (ElasticCloudAdapter.ACTION_DO_NOTHING, 0)
+        elif next_action == ElasticCloudAdapter.ACTION_SHRINK:
+            waited = now - max(state.get('last_expand', float('-inf')), state.get('last_shrink', float('-inf')))
+            if waited < self.scale_down_cooldown:
+                logger.info('shrink held back, %.0fs left of the scale down cooldown', self.scale_down_cooldown - waited)
+                return (ElasticCloudAdapter.ACTION_DO_NOTHING, 0)
+
+        if next_action == ElasticCloudAdapter.ACTION_DO_NOTHING or action_count <= 0:
+            return (ElasticCloudAdapter.ACTION_DO_NOTHING, 0)
+
+        if self.max_step:
+            action_count = min(action_count, self.max_step)
+        state['last_expand' if next_action == ElasticCloudAdapter.ACTION_EXPAND else 'last_shrink'] = now
+        return (next_action, action_count)
+
+    def _decide(self, load, counter_decision, state, now):
+        raise NotImplementedError
+
+    def demand(self, load):
+        # Nodes the current jobs need, busy ones plus the ones the broker backlog would keep busy
+        demand = load.busy
+        if load.probes:
+            # Nodes running several jobs each only need as many nodes as their jobs fill
+            jobs = sum(probe.jobs for probe in load.probes.values() if probe)
+            demand = int(math.ceil(jobs / float(load.jobs_per_node)))
+        if load.pending:
+            demand += int(math.ceil(load.pending / float(load.jobs_per_node)))
+        return demand
+
+    def capacity(self, load):
+        # Nodes that run jobs or soon will, booting ones were already asked for
+        return load.nodes - load.unknown + load.booting
+
+    def predicted_demand(self, state, horizon):
+        """
+        Demand horizon seconds from now, from a least squares line through the demand history.
+        Only a rising trend is extrapolated, scaling in never runs ahead of demand.
+        """
+        history = state.get('history') or []
+        if not history:
+            return 0
+        current = history[-1][1]
+        if len(history) < 2:
+            return current
+
+        mean_time = sum(time for time, _ in history) / float(len(history))
+        mean_demand = sum(demand for _, demand in history) / float(len(history))
+        variance = sum((time - mean_time) ** 2 for time, _ in history)
+        if not variance:
+            return current
+        slope = sum((time - mean_time) * (demand - mean_demand) for time, demand in history) / variance
+        return current + max(0.0, slope) * horizon
+
+
+class CounterPolicy(ScalingPolicy):
+    """
+    The original behaviour: expand by one node once every node was busy for EXPAND_CRITERION
+    ticks, or by the backlog with a broker load signal, and shrink nodes that were not busy for
+    SHRINK_CRITERION ticks.
+
+    With predictive set the fleet is also expanded ahead of time, when the trend of demand says
+    it will outgrow the fleet before new nodes could boot.
+    """
+
+    def __init__(self, predictive=False, **kwargs):
+        super().__init__(**kwargs)
+        self.predictive = predictive
+
+    def _decide(self, load, counter_decision, state, now):
+        if not self.predictive or counter_decision[0] == ElasticCloudAdapter.ACTION_EXPAND:
+            return counter_decision
+
+        capacity = self.capacity(load)
+        predicted = self.predicted_demand(state, load.boot_seconds)
+        if predicted > capacity:
+            logger.info('demand of %.1f nodes expected in %.0fs, %s nodes up', predicted, load.boot_seconds, capacity)
+            return (ElasticCloudAdapter.ACTION_EXPAND, int(math.ceil(predicted)) - capacity)
+        return counter_decision
+
+
+class TargetUtilizationPolicy(ScalingPolicy):
+    """
+    Sizes the fleet so that target of its nodes are busy.
+
+    Demand is the busy nodes plus the nodes the broker backlog needs, as predicted for when nodes
+    asked for now would be up. Nothing happens while the utilization stays within band of target,
+    outside of it the fleet is resized in one step to the number of nodes that brings it back to
+    target. Shrinking only lets go of idle nodes. The fleet never goes below min_nodes.
+    """
+
+    def __init__(self, target=0.75, band=0.15, min_nodes=0, **kwargs):
+        super().__init__(**kwargs)
+        self.target = target
+        self.band = band
+        self.min_nodes = min_nodes
+
+    def _decide(self, load, counter_decision, state, now):
+        demand = self.predicted_demand(state, load.boot_seconds)
+
+        capacity = self.capacity(load)
+        utilization = demand / float(capacity) if capacity else (1.0 if demand else 0.0)
+        logger.info('utilization %.2f, demand %.1f nodes, capacity %s nodes', utilization, demand, capacity)
+
+        wanted = max(self.min_nodes, int(math.ceil(demand / self.target)))
+        if utilization > self.target + self.band or capacity < self.min_nodes:
+            return (ElasticCloudAdapter.ACTION_EXPAND, wanted - capacity)
+
+        if utilization < self.target - self.band:
+            return (ElasticCloudAdapter.ACTION_SHRINK, min(capacity - wanted, load.idle))
+
+        return (ElasticCloudAdapter.ACTION_DO_NOTHING, 0)
+
+
+def scaling_policy_from_config(config):
+    kwargs = {
+        'max_step': int(config.get('max_scale_step') or 0) or None,
+        'scale_up_cooldown': float(config.get('scale_up_cooldown') or 0),
+        'scale_down_cooldown': float(config.get('scale_down_cooldown') or 0),
+        'trend_window': int(config.get('trend_window') or 5),
+    }
+    if config.get('scaling_policy', 'counter') == 'target':
+        return TargetUtilizationPolicy(float(config.get('target_utilization') or 0.75),
+                                       float(config.get('utilization_band') or 0.15),
+                                       int(config.get('min') or 0), **kwargs)
+    predictive = str(config.get('predictive_scaling') or '').lower() in ('y', 'yes', 't', 'true', 'on', '1')
+    return CounterPolicy(predictive, **kwargs)
@@ -0,0 +1,623 @@
+import io
+import json
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, deque, namedtuple
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime, timedelta
+
+from botocore.exceptions import ClientError
+from libcloud.common.google import GoogleBaseError, QuotaExceededError
+from paramiko import ssh_exception
+
+from GCEAdapter import GCEAdapter
+from LoadSignal import LoadReading, LoadSignal
+from NodeMetrics import PROBE_COMMAND, node_metrics
+from StateStore import StateStore
+
+
+# A job of the trace, arrival and duration are counted in ticks
+TraceJob = namedtuple('TraceJob', ['arrival', 'duration'])
+
+SimulationReport = namedtuple('SimulationReport', [
+    'ticks', 'jobs_submitted', 'jobs_completed', 'jobs_waiting', 'jobs_preempted',
+    'mean_wait', 'p95_wait', 'max_wait', 'node_hours', 'peak_nodes',
+    'nodes_created', 'nodes_destroyed', 'scale_outs', 'scale_ins', 'ticks_per_second',
+])
+
+SIMULATION_CONFIG = {
+    'BROKER_URL': None,
+    'max': 10,
+    'min': 1,
+    'shrink_sensitivity': 3,
+    'expand_sensitivity': 1,
+    'image_name': 'simulated-image',
+    'use_gpus': 'False',
+    'vm_size': 'n1-standard-1',
+    'datacenter': 'us-west1-a',
+    # Fake ssh answers right away, threads would only slow the simulation down
+    'probe_concurrency': 1,
+    'create_concurrency': 1,
+    'drain_deadline': 60,
+    'load_signal': 'ssh',
+    'jobs_per_node': 1,
+    'service_account_key': None,
+    'service_account_file': None,
+    'heartbeat_url': 'http://controller.internal:8111',
+    'heartbeat_token': 'simulated-token',
+    # Simulated ticks take no time, neither does backing off
+    'gce_requests_per_second': 0,
+    'gce_retry_delay': 0,
+    'warm_pool_startup_script': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts', 'GCE_Warm_Pool_Startup.sh'),
+}
+
+
+def synthetic_trace(ticks, arrival_rate, mean_duration, seed=None):
+    """
+    Poisson arrivals of arrival_rate jobs per tick, with exponentially distributed durations
+    averaging mean_duration ticks.
+    """
+    rng = random.Random(seed)
+    trace = []
+    for tick in range(ticks):
+        # Knuth's method, arrival rates are small
+        threshold = math.exp(-arrival_rate)
+        p = rng.random()
+        while p > threshold:
+            duration = max(1, int(math.ceil(rng.expovariate(1.0 / mean_duration))))
+            trace.append(TraceJob(tick, duration))
+            p *= rng.random()
+    return trace
+
+
+def load_trace(path, tick_seconds):
+    """
+    Reads a recorded trace, one "submitted,duration" line per job with both values in seconds.
+    Submission times are taken relative to the first job.
+    """
+    rows = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                submitted, duration = (float(value) for value in line.split(',')[:2])
+            except ValueError:
+                # Header line
+                continue
+            rows.append((submitted, duration))
+
+    if not rows:
+        return []
+
+    start = min(submitted for submitted, _ in rows)
+    trace = [TraceJob(int((submitted - start) // tick_seconds), max(1, int(math.ceil(duration / tick_seconds))))
+             for submitted, duration in rows]
+    return sorted(trace)
+
+
+def rate_limit_error():
+    # What GCE answers once a project goes over its request rate
+    return GoogleBaseError('Rate Limit Exceeded', 403, 'rateLimitExceeded')
+
+
+def _wait(latency):
+    if latency:
+        time.sleep(latency)
+
+
+class FakeS3Client:
+    """In-process stand-in for the parts of the boto3 S3 client elastic cloud uses."""
+
+    def __init__(self, latency=0):
+        self.objects = {}
+        self.calls = Counter()
+        self.latency = latency
+        self._versions = 0
+
+    def _error(self, code, operation):
+        return ClientError({'Error': {'Code': code}}, operation)
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.calls['get_object'] += 1
+        _wait(self.latency)
+        if Key not in self.objects:
+            raise self._error('NoSuchKey', 'GetObject')
+        body, etag = self.objects[Key]
+        if IfNoneMatch == etag:
+            raise self._error('304', 'GetObject')
+        return {'Body': io.BytesIO(body), 'ETag': etag}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+        self.calls['put_object'] += 1
+        _wait(self.latency)
+        current = self.objects.get(Key)
+        if IfNoneMatch == '*' and current:
+            raise self._error('PreconditionFailed', 'PutObject')
+        if IfMatch and (not current or current[1] != IfMatch):
+            raise self._error('PreconditionFailed', 'PutObject')
+        self._versions += 1
+        etag = '"{}"'.format(self._versions)
+        self.objects[Key] = (Body, etag)
+        return {'ETag': etag}
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None):
+        self.calls['list_objects_v2'] += 1
+        return {'Contents': [{'Key': key} for key in sorted(self.objects) if key.startswith(Prefix)], 'IsTruncated': False}
+
+    def delete_object(self, Bucket, Key, IfMatch=None):
+        self.calls['delete_object'] += 1
+        current = self.objects.get(Key)
+        if IfMatch and current and current[1] != IfMatch:
+            raise self._error('PreconditionFailed', 'DeleteObject')
+        self.objects.pop(Key, None)
+
+
+class FakeNode:
+    """A simulated VM, shaped like the libcloud nodes the adapter reads."""
+
+    def __init__(self, name, ip, created, zone=None):
+        self.name = name
+        self.id = name
+        self.public_ips = [ip]
+        self.state = 'running'
+        self.extra = {}
+        self.zone = zone
+        self.created = created
+        # Tick the node was last started, ssh and the worker come up relative to it
+        self.booted = created
+        # Worker container: starting until the image is pulled, then running until docker stop
+        self.worker = 'starting'
+        self.job = None
+        # Warm pool nodes power off once the image is pulled on their first boot
+        self.warm = False
+        self.warmed = False
+
+    def probe(self):
+        # What PROBE_COMMAND prints, /tmp/codalab has an entry of its own next to the running job
+        worker = {'starting': 'missing', 'stopped': 'exited'}.get(self.worker, self.worker)
+        return {'entries': 2 if self.job else 1, 'worker': worker, 'load': 1.0 if self.job else 0.05,
+                'disk_free': 50 * 1024 ** 3, 'gpu': None}
+
+
+class FakeGCEDriver:
+    """
+    Stands in for the libcloud GCE driver.
+
+    A new node accepts ssh connections ssh_ticks after it was created and runs compute_worker
+    after boot_ticks. Calls are counted so tests and benchmarks can check the API budget.
+
+    Nodes created with the warm pool metadata power off after boot_ticks instead, and keep their
+    pulled image. Stopped nodes have no ip, starting one gives it a new one.
+
+    zone_capacity maps zone -> how many nodes fit in it, zones not in it never run out. Errors
+    queued with fail() are raised by the next calls of a method, before it does anything.
+    """
+
+    def __init__(self, boot_ticks=3, ssh_ticks=1, quota=None, latency=0):
+        self.boot_ticks = boot_ticks
+        self.ssh_ticks = ssh_ticks
+        self.quota = quota
+        self.latency = latency
+        self.tick = 0
+        self.nodes = {}
+        self.calls = Counter()
+        self.created = 0
+        self.warm_created = 0
+        self._addresses = 0
+        self._by_ip = {}
+        self._lock = threading.Lock()
+        # Called with every node stopped while running, see Simulator.stop_worker()
+        self.on_stop = None
+        self.zone_capacity = {}
+        self.errors = {}
+
+    def fail(self, method, *errors):
+        self.errors.setdefault(method, deque()).extend(errors)
+
+    def _inject(self, method):
+        errors = self.errors.get(method)
+        if errors:
+            raise errors.popleft()
+
+    def list_nodes(self, ex_filter=None):
+        self.calls['list_nodes'] += 1
+        _wait(self.latency)
+        self._inject('list_nodes')
+        if ex_filter:
+            # Only the 'name eq "regex"' filters elastic cloud sends
+            pattern = re.compile(ex_filter.split(' eq ', 1)[1].strip('"'))
+            return [node for node in self.nodes.values() if pattern.fullmatch(node.name)]
+        return list(self.nodes.values())
+
+    def _new_ip(self):
+        # Addresses are never recycled within a run
+        self._addresses += 1
+        n = self._addresses
+        return '10.{}.{}.{}'.format(n // 65536 % 256, n // 256 % 256, n % 256)
+
+    def create_node(self, name, size=None, image=None, location=None, ex_metadata=None, **arguments):
+        _wait(self.latency)
+        with self._lock:
+            self.calls['create_node'] += 1
+            self._inject('create_node')
+            if name in self.nodes:
+                raise Exception('The resource {} already exists'.format(name))
+            if self.quota is not None and len(self.nodes) >= self.quota:
+                raise QuotaExceededError('Quota exceeded', 403, 'QUOTA_EXCEEDED')
+            in_zone = sum(1 for node in self.nodes.values() if node.zone == location)
+            if in_zone >= self.zone_capacity.get(location, float('inf')):
+                raise GoogleBaseError('The zone {} does not have enough resources'.format(location), 200,
+                                      'ZONE_RESOURCE_POOL_EXHAUSTED')
+            self.created += 1
+            ip = self._new_ip()
+            node = self.nodes[name] = self._by_ip[ip] = FakeNode(name, ip, self.tick, location)
+            if ex_metadata and ex_metadata.get('elastic-cloud-warm') == 'true':
+                node.warm = True
+                self.warm_created += 1
+            return node
+
+    def ex_start_node(self, node, sync=True):
+        _wait(self.latency)
+        with self._lock:
+            self.calls['ex_start_node'] += 1
+            self._inject('ex_start_node')
+            node = self.nodes[node.name]
+            if node.state != 'stopped':
+                raise Exception('The resource {} is not stopped'.format(node.name))
+            ip = self._new_ip()
+            node.public_ips = [ip]
+            self._by_ip[ip] = node
+            node.state = 'running'
+            node.booted = self.tick
+            return True
+
+    def ex_stop_node(self, node, sync=True):
+        _wait(self.latency)
+        with self._lock:
+            self.calls['ex_stop_node'] += 1
+            self._inject('ex_stop_node')
+            node = self.nodes[node.name]
+            self._power_off(node)
+            return True
+
+    def _power_off(self, node):
+        if node.state == 'running' and self.on_stop:
+            self.on_stop(node)
+        node.worker = 'stopped'
+        node.state = 'stopped'
+        for ip in node.public_ips:
+            self._by_ip.pop(ip, None)
+        node.public_ips = []
+
+    def ex_destroy_multiple_nodes(self, nodes):
+        _wait(self.latency)
+        with self._lock:
+            self.calls['ex_destroy_multiple_nodes'] += 1
+            self._inject('ex_destroy_multiple_nodes')
+            for node in nodes:
+                self.nodes.pop(node.name, None)
+                for ip in node.public_ips:
+                    self._by_ip.pop(ip, None)
+            return [True] * len(nodes)
+
+    def node_at(self, host):
+        return self._by_ip.get(host)
+
+    def advance(self, tick):
+        self.tick = tick
+        for node in self.nodes.values():
+            if node.worker == 'starting' and tick - node.booted >= self.boot_ticks:
+                if node.warm and not node.warmed:
+                    node.warmed = True
+                    self._power_off(node)
+                else:
+                    node.worker = 'running'
+
+    def running(self):
+        return [node for node in self.nodes.values() if node.state == 'running']
+
+
+class FakeSSHClient:
+    """Answers the commands elastic cloud runs on workers from the simulated node."""
+
+    def __init__(self, driver, host, simulator):
+        self.driver = driver
+        self.host = host
+        self.simulator = simulator
+
+    def get_transport(self):
+        return self
+
+    def set_keepalive(self, interval):
+        pass
+
+    def is_active(self):
+        return self.driver.node_at(self.host) is not None
+
+    def close(self):
+        pass
+
+    def exec_command(self, command):
+        self.simulator.ssh_calls['exec_command'] += 1
+        _wait(self.simulator.ssh_latency)
+        node = self.driver.node_at(self.host)
+        if node is None:
+            raise ssh_exception.SSHException('Connection to {} was lost'.format(self.host))
+
+        if command == PROBE_COMMAND:
+            out = [json.dumps(node.probe()) + '\n']
+        elif command == 'sudo docker ps':
+            out = ['CONTAINER ID\n']
+            if node.worker == 'running':
+                out.append('abc123 codalab/competitions-v1-compute-worker compute_worker\n')
+        elif command.startswith('sudo docker stop'):
+            self.simulator.stop_worker(node)
+            out = ['compute_worker\n']
+        elif command == 'sudo docker start compute_worker':
+            if node.worker == 'stopped':
+                node.worker = 'running'
+            out = ['compute_worker\n']
+        else:
+            out = []
+        return (None, io.StringIO(''.join(out)), io.StringIO())
+
+
+class SimulatedQueueSignal(LoadSignal):
+    """Broker load signal reading the simulated job queue."""
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def read(self):
+        return LoadReading(len(self.simulator.queue), self.simulator.consumers())
+
+
+class SimulatedGCEAdapter(GCEAdapter):
+    """GCEAdapter wired to the fake driver, fake ssh and in-memory S3 of a Simulator."""
+
+    def __init__(self, simulator, config):
+        self.simulator = simulator
+        self._simulation_config = config
+        super().__init__()
+
+    def _load_configuration(self, service_name):
+        self.config = dict(self._simulation_config)
+
+    def _load_ssh_key(self):
+        self.username = 'ubuntu'
+        self.pkey = None
+
+    def _configure_cloudcube(self):
+        self.CLOUDCUBE_URL = 'https://cloud-cube.s3.amazonaws.com/simulated'
+        self.CLOUDCUBE_ACCESS_KEY_ID = None
+        self.CLOUDCUBE_SECRET_ACCESS_KEY = None
+
+    def _load_gce_account(self):
+        self.service_account = {'client_email': 'simulator@example.com', 'project_id': 'simulated'}
+        self.service_account_email = self.service_account['client_email']
+        return self.gce_client.wrap(self._new_gce_driver())
+
+    def _new_gce_driver(self):
+        return self.metrics.instrument(self.simulator.driver, 'gce')
+
+    def _load_boto_client(self):
+        self.s3_client = self.metrics.instrument(self.simulator.s3_client, 's3')
+        self.s3_bucket_name = 'cloud-cube'
+        self.s3_state_file_location = 'simulated/gce_states'
+        self.local_state_file_location = os.devnull
+        self.state_store = StateStore(self.s3_client, self.s3_bucket_name, self.s3_state_file_location, self.local_state_file_location)
+        self.state_store.initialize({'node': {}, 'container': {}})
+        self.journal = self._new_journal('simulated/gce_journal/', None)
+
+    def _connect(self, host):
+        self.simulator.ssh_calls['connect'] += 1
+        _wait(self.simulator.ssh_latency)
+        node = self.simulator.driver.node_at(host)
+        if node is None or self.simulator.tick - node.booted < self.simulator.driver.ssh_ticks:
+            raise ssh_exception.NoValidConnectionsError({(host, 22): ConnectionRefusedError()})
+        return FakeSSHClient(self.simulator.driver, host, self.simulator)
+
+    def _now(self):
+        return self.simulator.now()
+
+    def _submit_refill(self, names, arguments):
+        # No background thread, the fake driver answers right away
+        self._refill(names, arguments)
+
+
+class _NullWriter(io.TextIOBase):
+    def write(self, s):
+        return len(s)
+
+
+class Simulator:
+    """
+    Replays a job trace against the real scaling code.
+
+    Every tick jobs arrive, finish and get picked up by idle workers, then one controller tick
+    runs exactly like the daemon runs it. Nothing leaves the process, so a day of one minute
+    ticks takes well under a second.
+    """
+
+    def __init__(self, trace, config=None, boot_ticks=3, ssh_ticks=1, tick_seconds=60, quota=None, latencies=None,
+                 verbose=False):
+        # latencies: seconds every 'gce', 'ssh' and 's3' call takes, all instant by default
+        latencies = latencies or {}
+        self.trace = sorted(trace)
+        self.config = dict(SIMULATION_CONFIG, **(config or {}))
+        self.tick_seconds = tick_seconds
+        self.verbose = verbose
+        self.start = datetime(2019, 4, 1)
+        self.tick = 0
+
+        self.driver = FakeGCEDriver(boot_ticks, ssh_ticks, quota, latencies.get('gce', 0))
+        self.driver.on_stop = self.stop_worker
+        self.s3_client = FakeS3Client(latencies.get('s3', 0))
+        self.ssh_latency = latencies.get('ssh', 0)
+        self.ssh_calls = Counter()
+        self.queue = deque()
+        self.waits = []
+        self.completed = 0
+        self.preempted = 0
+        self.node_ticks = 0
+        self.peak_nodes = 0
+        self.scale_outs = 0
+        self.scale_ins = 0
+
+        with self.quiet():
+            self.adapter = SimulatedGCEAdapter(self, self.config)
+        if self.config.get('load_signal') == 'broker':
+            self.adapter.load_signal = SimulatedQueueSignal(self)
+        if self.adapter.probe_mode == 'heartbeat':
+            # As if the heartbeat server had been up for a while, nodes push in _send_heartbeats()
+            self.adapter.heartbeats.since = float('-inf')
+
+    def now(self):
+        return self.start + timedelta(seconds=self.tick * self.tick_seconds)
+
+    def populate(self, count, busy=0):
+        """
+        Starts the simulation with count nodes that already run compute_worker, the first busy of
+        them working on a job that never finishes.
+        """
+        for i in range(count):
+            created = self.start - timedelta(seconds=count - i)
+            node = self.driver.create_node('cpu-' + created.strftime(self.adapter.format) + '-000')
+            node.created = node.booted = -self.driver.boot_ticks
+            node.worker = 'running'
+            if i < busy:
+                node.job = (TraceJob(-1, float('inf')), -1)
+
+    def consumers(self):
+        return sum(1 for node in self.driver.nodes.values() if node.worker == 'running')
+
+    def stop_worker(self, node):
+        if node.job:
+            # Killed by docker stop, the broker hands the job to another worker and it waits
+            # in the queue all over again
+            self.queue.appendleft(TraceJob(self.tick, node.job[0].duration))
+            self.preempted += 1
+            node.job = None
+        node.worker = 'stopped'
+
+    @contextmanager
+    def quiet(self):
+        # The adapter logs and echoes everything it does, only worth reading when debugging
+        if self.verbose:
+            yield
+            return
+
+        previous = logging.root.manager.disable
+        logging.disable(logging.CRITICAL)
+        try:
+            with redirect_stdout(_NullWriter()):
+                yield
+        finally:
+            logging.disable(previous)
+
+    def _run_jobs(self):
+        for node in self.driver.nodes.values():
+            job = node.job
+            if job and self.tick - job[1] >= job[0].duration:
+                node.job = None
+                self.completed += 1
+
+        for node in sorted(self.driver.running(), key=lambda node: node.created):
+            if not self.queue:
+                break
+            if node.worker == 'running' and node.job is None:
+                job = self.queue.popleft()
+                self.waits.append(self.tick - job.arrival)
+                node.job = (job, self.tick)
+
+    def _send_heartbeats(self):
+        # Sidecars come up with ssh, once the node booted
+        for node in self.driver.running():
+            if self.tick - node.booted >= self.driver.ssh_ticks:
+                self.adapter.heartbeats.record(node.name, node_metrics(node.probe()))
+
+    def _scaling_calls(self):
+        calls = self.driver.calls
+        # Nodes created for the warm pool don't add capacity
+        scale_outs = calls['create_node'] - self.driver.warm_created + calls['ex_start_node']
+        return scale_outs, calls['ex_destroy_multiple_nodes'] + calls['ex_stop_node']
+
+    def step(self):
+        from cloud import run_auto_scale_tick
+
+        self.driver.advance(self.tick)
+        self._run_jobs()
+        if self.adapter.probe_mode == 'heartbeat':
+            self._send_heartbeats()
+
+        scaled_out, scaled_in = self._scaling_calls()
+        with self.quiet():
+            self.adapter.begin_tick()
+            run_auto_scale_tick(self.adapter)
+        scale_outs, scale_ins = self._scaling_calls()
+        if scale_outs > scaled_out:
+            self.scale_outs += 1
+        if scale_ins > scaled_in:
+            self.scale_ins += 1
+
+        # Stopped nodes only cost their disks
+        running = len(self.driver.running())
+        self.node_ticks += running
+        self.peak_nodes = max(self.peak_nodes, running)
+        self.tick += 1
+
+    def run(self, ticks=None):
+        if ticks is None:
+            # Play the whole trace, then give the fleet time to finish and scale back in
+            last = max((job.arrival + job.duration for job in self.trace), default=0)
+            ticks = last + self.driver.boot_ticks + 2 * self.config['shrink_sensitivity'] + 1
+
+        arrivals = deque(self.trace)
+        started = time.perf_counter()
+        for _ in range(ticks):
+            while arrivals and arrivals[0].arrival <= self.tick:
+                self.queue.append(arrivals.popleft())
+            self.step()
+        elapsed = time.perf_counter() - started
+
+        # Jobs still queued at the end count with the wait they have accumulated so far
+        waits = sorted(self.waits + [self.tick - job.arrival for job in self.queue])
+        return SimulationReport(
+            ticks=ticks,
+            jobs_submitted=len(self.trace) - len(arrivals),
+            jobs_completed=self.completed,
+            jobs_waiting=len(self.queue),
+            jobs_preempted=self.preempted,
+            mean_wait=(sum(waits) / len(waits) * self.tick_seconds) if waits else 0,
+            p95_wait=(waits[max(0, int(math.ceil(0.95 * len(waits))) - 1)] * self.tick_seconds) if waits else 0,
+            max_wait=(waits[-1] * self.tick_seconds) if waits else 0,
+            node_hours=self.node_ticks * self.tick_seconds / 3600.0,
+            peak_nodes=self.peak_nodes,
+            nodes_created=self.driver.created,
+            nodes_destroyed=self.driver.created - len(self.driver.nodes),
+            scale_outs=self.scale_outs,
+            scale_ins=self.scale_ins,
+            ticks_per_second=ticks / elapsed if elapsed else 0,
+        )
+
+
+def format_report(report):
+    lines = [
+        '{0: <20} {1}'.format('ticks', report.ticks),
+        '{0: <20} {1} submitted, {2} completed, {3} waiting, {4} preempted'.format(
+            'jobs', report.jobs_submitted, report.jobs_completed, report.jobs_waiting, report.jobs_preempted),
+        '{0: <20} mean {1:.0f}s, p95 {2:.0f}s, max {3:.0f}s'.format('queue wait', report.mean_wait, report.p95_wait, report.max_wait),
+        '{0: <20} {1:.1f}'.format('node hours', report.node_hours),
+        '{0: <20} {1}'.format('peak nodes', report.peak_nodes),
+        '{0: <20} {1} created, {2} destroyed, {3} scale outs, {4} scale ins'.format(
+            'churn', report.nodes_created, report.nodes_destroyed, report.scale_outs, report.scale_ins),
+        '{0: <20} {1:.0f}'.format('ticks per second', report.ticks_per_second),
+    ]
+    return '\n'.join(lines)
@@ -0,0 +1,326 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+
+logger = logging.getLogger(__name__)
+
+
+# Error codes S3 answers with when a conditional write lost the race
+CONFLICT_ERROR_CODES = ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409')
+NOT_MODIFIED_ERROR_CODES = ('304', 'NotModified')
+
+
+def is_conflict(error):
+    return error.response.get('Error', {}).get('Code') in CONFLICT_ERROR_CODES
+
+
+class StateConflictError(Exception):
+    pass
+
+
+class LeaseLostError(Exception):
+    pass
+
+
+class StateStore:
+    """
+    Tick-scoped cache of the elastic cloud state file kept in S3.
+
+    The state file is downloaded the first time it is needed and then served from memory. Sections
+    that are written are marked dirty, and everything is uploaded once by flush() at the end of the
+    tick. The upload is skipped when the content hash matches what is already stored.
+
+    Uploads are conditional on the ETag seen when the file was read. If another controller wrote
+    the file in the meantime the remote copy is read again, the keys this tick changed are merged
+    on top of it and the write is retried.
+    """
+
+    MAX_WRITE_ATTEMPTS = 5
+
+    def __init__(self, s3_client, bucket_name, remote_location, local_location):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.remote_location = remote_location
+        self.local_location = local_location
+
+        self._states = None
+        # Copy of the states as last read from / written to S3, the base for merges
+        self._base = None
+        self._etag = None
+        self._stored_hash = None
+        self.dirty = set()
+
+    @property
+    def loaded(self):
+        return self._states is not None
+
+    @property
+    def version(self):
+        # ETag of the state file the cached states were read from or last written as
+        return self._etag
+
+    def load(self):
+        if self._states is None:
+            self._states, self._etag = self._read()
+            self._base = copy.deepcopy(self._states)
+            self._stored_hash = self._hash(self._states)
+        return self._states
+
+    def get(self, section):
+        return self.load()[section]
+
+    def set(self, section, value):
+        states = self.load()
+        states[section] = value
+        self.dirty.add(section)
+
+    def initialize(self, states):
+        # Used when there is no state file in S3 yet
+        self._states = states
+        self._base = {}
+        self._etag = None
+        self._stored_hash = None
+        self.dirty = set(states)
+        self.flush()
+
+    def flush(self):
+        if self._states is None:
+            return
+
+        for attempt in range(self.MAX_WRITE_ATTEMPTS):
+            content_hash = self._hash(self._states)
+            if content_hash == self._stored_hash:
+                self.dirty.clear()
+                return
+
+            try:
+                self._etag = self._write(self._states, self._etag)
+            except ClientError as e:
+                if not is_conflict(e):
+                    raise
+                logger.info('States were changed by another controller, merging and retrying')
+                theirs, self._etag = self._read()
+                self._states = self._merge(theirs)
+                self._base = copy.deepcopy(theirs)
+                self._stored_hash = self._hash(theirs)
+                continue
+
+            with open(self.local_location, 'w+') as state_file:
+                state_file.write(json.dumps(self._states))
+
+            self._base = copy.deepcopy(self._states)
+            self._stored_hash = content_hash
+            self.dirty.clear()
+            return
+
+        raise StateConflictError('Could not store states after {} attempts'.format(self.MAX_WRITE_ATTEMPTS))
+
+    def refresh(self):
+        # Called at the start of a tick in daemon mode, only downloads the file again if it changed
+        if self._states is None or self._etag is None:
+            self.invalidate()
+            return self.load()
+
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.remote_location, IfNoneMatch=self._etag)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in NOT_MODIFIED_ERROR_CODES:
+                return self._states
+            raise
+
+        self._states = json.loads(response['Body'].read())
+        self._etag = response['ETag']
+        self._base = copy.deepcopy(self._states)
+        self._stored_hash = self._hash(self._states)
+        self.dirty.clear()
+        return self._states
+
+    def checkpoint(self):
+        # The cached states as they are, to go back to with rollback()
+        return copy.deepcopy(self.load()), set(self.dirty)
+
+    def changes(self, checkpoint):
+        # Sections that differ from the checkpoint, as they are now
+        states = checkpoint[0]
+        return {section: copy.deepcopy(value) for section, value in self.load().items() if states.get(section) != value}
+
+    def rollback(self, checkpoint):
+        states, dirty = checkpoint
+        self._states = states
+        self.dirty = set(dirty)
+
+    def invalidate(self):
+        # Next load() downloads the state file again, unflushed changes are dropped
+        self._states = None
+        self._base = None
+        self._etag = None
+        self._stored_hash = None
+        self.dirty.clear()
+
+    def lease(self, ttl):
+        return StateLease(self.s3_client, self.bucket_name, self.remote_location + '.lock', ttl)
+
+    def _read(self):
+        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.remote_location)
+        states = json.loads(response['Body'].read())
+        return states, response['ETag']
+
+    def _write(self, states, etag):
+        arguments = {
+            'Bucket': self.bucket_name,
+            'Key': self.remote_location,
+            'Body': json.dumps(states).encode('utf-8'),
+        }
+        if etag:
+            arguments['IfMatch'] = etag
+        else:
+            arguments['IfNoneMatch'] = '*'
+        return self.s3_client.put_object(**arguments)['ETag']
+
+    def _changed_sections(self):
+        sections = set(self.dirty)
+        for section in set(self._states) | set(self._base):
+            if self._states.get(section) != self._base.get(section):
+                sections.add(section)
+        return sections
+
+    def _merge(self, theirs):
+        # Three way merge per node: keys this controller changed since its read win, everything
+        # else is taken from the newer remote copy
+        merged = copy.deepcopy(theirs)
+        for section in self._changed_sections():
+            base_section = self._base.get(section) or {}
+            our_section = self._states.get(section) or {}
+            merged_section = merged.setdefault(section, {})
+
+            for key in set(base_section) | set(our_section):
+                if key not in our_section:
+                    merged_section.pop(key, None)
+                elif base_section.get(key) != our_section[key]:
+                    merged_section[key] = copy.deepcopy(our_section[key])
+        return merged
+
+    def _hash(self, states):
+        return hashlib.sha256(json.dumps(states, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class StateLease:
+    """
+    Advisory lock object stored next to the state file.
+
+    Only one controller can hold the lease at a time. It expires after ttl seconds so a controller
+    that died mid-tick does not block everyone else forever. Ticks that may run longer than that
+    keep it with start_renewing(), and check() between their phases that it is still theirs.
+    """
+
+    def __init__(self, s3_client, bucket_name, remote_location, ttl):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.remote_location = remote_location
+        self.ttl = ttl
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.held = False
+        # When the lease runs out unless it is renewed
+        self.expires = 0
+        self._etag = None
+        self._stop_renewing = None
+        self._renewer = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self):
+        try:
+            self._etag = self._put(IfNoneMatch='*')
+            self.held = True
+            return True
+        except ClientError as e:
+            if not is_conflict(e):
+                raise
+
+        # Someone else holds it, take it over only if it expired
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.remote_location)
+        except ClientError:
+            return False
+        current = json.loads(response['Body'].read())
+        if current['expires'] > time.time():
+            logger.info('State lease is held by %s for another %.0fs', current['owner'], current['expires'] - time.time())
+            return False
+
+        try:
+            self._etag = self._put(IfMatch=response['ETag'])
+            self.held = True
+            return True
+        except ClientError as e:
+            if not is_conflict(e):
+                raise
+            return False
+
+    def renew(self):
+        if not self.held:
+            return False
+        try:
+            self._etag = self._put(IfMatch=self._etag)
+            return True
+        except ClientError as e:
+            if not is_conflict(e):
+                raise
+            self.held = False
+            return False
+
+    def start_renewing(self, interval=None):
+        # Renews the lease every third of its ttl from a background thread, until released or lost
+        self._stop_renewing = threading.Event()
+        self._renewer = threading.Thread(target=self._renew_until_stopped, args=(interval or self.ttl / 3.0,),
+                                         daemon=True)
+        self._renewer.start()
+
+    def _renew_until_stopped(self, interval):
+        while not self._stop_renewing.wait(interval):
+            try:
+                if not self.renew():
+                    logger.warning('State lease was taken over by another controller')
+                    return
+            except Exception:
+                # Tried again after the next interval, check() tells once it ran out
+                logger.exception('Could not renew the state lease')
+
+    def check(self):
+        if not self.held or time.time() >= self.expires:
+            raise LeaseLostError('State lease lost, another controller may be working on the fleet')
+
+    def release(self):
+        if self._renewer is not None:
+            self._stop_renewing.set()
+            self._renewer.join()
+            self._renewer = None
+        if not self.held:
+            return
+        self.held = False
+        try:
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=self.remote_location, IfMatch=self._etag)
+        except ClientError as e:
+            # The lease expired and was taken over, it is not ours to delete any more
+            if not is_conflict(e):
+                raise
+
+    def _put(self, **conditions):
+        expires = time.time() + self.ttl
+        body = json.dumps({'owner': self.owner, 'expires': expires}).encode('utf-8')
+        response = self.s3_client.put_object(Bucket=self.bucket_name, Key=self.remote_location, Body=body, **conditions)
+        self.expires = expires
+        return response['ETag']
@@ -0,0 +1,42 @@
+from collections import namedtuple
+
+
+# A running node shrink could take down: its status and the ticks it has been in it, from the
+# node states get_next_action keeps, the status of its container and when it was created
+Candidate = namedtuple('Candidate', ['name', 'status', 'count', 'container', 'created'])
+
+# compute_worker is still coming up on these, they have not had a chance to take a job yet
+PROTECTED_STATUSES = ('MANAGED',)
+PROTECTED_CONTAINERS = ('STARTING',)
+
+# Nodes already being drained go first, then idle ones, then the ones that could not be probed.
+# Busy nodes only go when nothing else is left, their running job is killed and has to run again.
+RANKS = {'NOT-BUSY': 1, 'UNKNOWN': 2, 'BUSY': 3}
+
+
+def billing_seconds_left(created, now, billing_seconds):
+    # Seconds until the node's current billing period ends, paid for whether it runs or not
+    age = max(0, (now - created).total_seconds())
+    return billing_seconds - age % billing_seconds
+
+
+def select_victims(candidates, n, now=None, billing_seconds=0):
+    """
+    Names of up to n candidates to take down, best first.
+
+    Nodes in PROTECTED_STATUSES or PROTECTED_CONTAINERS are never picked, so fewer than n may come
+    back. The others go by RANKS, and within a rank the longest streak in their status goes first,
+    oldest first among equals. With billing_seconds, nodes closest to the end of the billing
+    period they already paid for go before the streak is looked at.
+    """
+    def key(candidate):
+        if candidate.container == 'STOPPING':
+            rank = 0
+        else:
+            rank = RANKS.get(candidate.status, RANKS['UNKNOWN'])
+        left = billing_seconds_left(candidate.created, now, billing_seconds) if billing_seconds else 0
+        return (rank, left, -candidate.count, candidate.created, candidate.name)
+
+    eligible = [candidate for candidate in candidates
+                if candidate.status not in PROTECTED_STATUSES and candidate.container not in PROTECTED_CONTAINERS]
+    return [candidate.name for candidate in sorted(eligible, key=key)[:n]]
@@ -0,0 +1,193 @@
+"""
+Benchmarks for the controller tick and its phases, on fleets of simulated nodes, and for the
+startup time of cloud.py.
+
+    python -m pytest benchmarks.py
+
+Timings need pytest-benchmark. The call budget tests run without it and fail when a change makes
+a tick talk to GCE, S3 or the workers more often than it does now, or makes cloud.py import a
+cloud SDK before a command needs it.
+"""
+import os
+import subprocess
+import sys
+from collections import Counter
+
+import pytest
+
+from Simulator import Simulator
+
+try:
+    import pytest_benchmark  # noqa: F401
+except ImportError:
+    @pytest.fixture
+    def benchmark():
+        def run(function, *args, **kwargs):
+            return function(*args, **kwargs)
+        return run
+
+
+FLEET_SIZES = [1, 10, 100, 500]
+
+# External calls a steady state tick may make, whatever the size of the fleet
+GCE_LIST_CALLS_PER_TICK = 1
+S3_GETS_PER_TICK = 1
+S3_PUTS_PER_TICK = 1
+SSH_CONNECTS_PER_TICK = 0
+# One probe per node, shared by everything that reads the fleet during the tick
+SSH_COMMANDS_PER_NODE = 1
+
+# Cloud SDKs that must not be imported before a command actually talks to the cloud
+SDK_MODULES = ['boto3', 'botocore.client', 'libcloud', 'paramiko']
+
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def build_fleet(size, latencies=None, config=None):
+    fleet_config = {'max': size, 'min': size, 'ssh_max_sessions': max(50, size)}
+    fleet_config.update(config or {})
+    simulator = Simulator([], fleet_config, latencies=latencies)
+    simulator.populate(size, busy=size // 2)
+    # The first tick connects to every node and writes the initial states
+    simulator.step()
+    return simulator
+
+
+def external_calls(simulator):
+    calls = Counter()
+    calls['gce_list'] = simulator.driver.calls['list_nodes']
+    calls['s3_get'] = simulator.s3_client.calls['get_object']
+    calls['s3_put'] = simulator.s3_client.calls['put_object']
+    calls['ssh_connect'] = simulator.ssh_calls['connect']
+    calls['ssh_command'] = simulator.ssh_calls['exec_command']
+    return calls
+
+
+@pytest.mark.parametrize('size', FLEET_SIZES)
+def test_tick_call_budget(size):
+    simulator = build_fleet(size)
+
+    before = external_calls(simulator)
+    simulator.step()
+    calls = external_calls(simulator) - before
+
+    assert calls['gce_list'] <= GCE_LIST_CALLS_PER_TICK
+    assert calls['s3_get'] <= S3_GETS_PER_TICK
+    assert calls['s3_put'] <= S3_PUTS_PER_TICK
+    assert calls['ssh_connect'] <= SSH_CONNECTS_PER_TICK
+    assert calls['ssh_command'] <= SSH_COMMANDS_PER_NODE * size
+
+
+@pytest.mark.parametrize('size', FLEET_SIZES)
+def test_heartbeat_tick_call_budget(size):
+    simulator = build_fleet(size, config={'probe_mode': 'heartbeat'})
+
+    before = external_calls(simulator)
+    simulator.step()
+    calls = external_calls(simulator) - before
+
+    # Workers push their state, a tick talks to none of them
+    assert calls['gce_list'] <= GCE_LIST_CALLS_PER_TICK
+    assert calls['ssh_connect'] == 0
+    assert calls['ssh_command'] == 0
+
+
+@pytest.mark.parametrize('size', FLEET_SIZES)
+def test_tick(benchmark, size):
+    simulator = build_fleet(size)
+    benchmark(simulator.step)
+
+
+@pytest.mark.parametrize('size', FLEET_SIZES)
+def test_list_nodes(benchmark, size):
+    simulator = build_fleet(size)
+    adapter = simulator.adapter
+
+    def list_nodes():
+        adapter.invalidate_snapshot()
+        return adapter.get_snapshot()
+
+    with simulator.quiet():
+        benchmark(list_nodes)
+
+
+@pytest.mark.parametrize('size', FLEET_SIZES)
+def test_dump_state(benchmark, size):
+    simulator = build_fleet(size)
+    snapshot = simulator.adapter.get_snapshot()
+
+    def dump_state():
+        # Probe again every round instead of reading the cached probes
+        snapshot.probes = None
+        return simulator.adapter.dump_state(snapshot)
+
+    with simulator.quiet():
+        benchmark(dump_state)
+
+
+@pytest.mark.parametrize('size', FLEET_SIZES)
+def test_update_all_states(benchmark, size):
+    simulator = build_fleet(size)
+    snapshot = simulator.adapter.get_snapshot()
+    with simulator.quiet():
+        benchmark(simulator.adapter.update_all_states, snapshot)
+
+
+@pytest.mark.parametrize('size', FLEET_SIZES)
+def test_get_next_action(benchmark, size):
+    simulator = build_fleet(size)
+    snapshot = simulator.adapter.get_snapshot()
+    with simulator.quiet():
+        benchmark(simulator.adapter.get_next_action, snapshot)
+
+
+@pytest.mark.parametrize('size', FLEET_SIZES)
+def test_state_round_trip(benchmark, size):
+    simulator = build_fleet(size)
+    adapter = simulator.adapter
+
+    def round_trip():
+        # What every tick does with the state file: refresh, change the node counters, upload
+        adapter.state_store.refresh()
+        states = adapter._load_states()['node']
+        for name in states:
+            states[name]['count'] += 1
+        adapter._store_states(states, 'node')
+        adapter.state_store.flush()
+
+    with simulator.quiet():
+        benchmark(round_trip)
+
+
+@pytest.mark.parametrize('size', [10, 100])
+def test_tick_with_latency(benchmark, size):
+    # Roughly what the controller sees from a GCE zone: slow API calls, fast ssh inside the VPC
+    latencies = {'gce': 0.05, 's3': 0.02, 'ssh': 0.002}
+    simulator = build_fleet(size, latencies, {'probe_concurrency': 10})
+    benchmark(simulator.step)
+
+
+def run_python(*arguments):
+    return subprocess.run([sys.executable] + list(arguments), cwd=REPOSITORY, check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def test_cli_startup_imports_no_sdks():
+    code = """
+import sys
+import cloud
+try:
+    cloud.cli(['--help'])
+except SystemExit:
+    pass
+sys.stderr.write(','.join(m for m in {!r} if m in sys.modules))
+""".format(SDK_MODULES)
+    assert run_python('-c', code).stderr == ''
+
+
+def test_import_time(benchmark):
+    benchmark(run_python, '-c', 'import cloud')
+
+
+def test_cli_help_startup(benchmark):
+    benchmark(run_python, 'cloud.py', '--help')
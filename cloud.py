@@ -1,77 +1,333 @@
 #!/usr/bin/env python3
+import logging
+
 import click
+from ControlLoop import ControlLoop
 from ElasticCloudAdapter import ElasticCloudAdapter
-from GCEAdapter import GCEAdapter
 
 
-def adapter_choice(driver):
+logger = logging.getLogger(__name__)
+
+
+# Adapters pull in their cloud SDKs, they are only imported once a command needs one
+def __getattr__(name):
+    if name == 'GCEAdapter':
+        from GCEAdapter import GCEAdapter
+        return GCEAdapter
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def adapter_choice(driver, pool=None):
     if driver == 'gce':
-        return GCEAdapter()
+        from GCEAdapter import GCEAdapter
+        return GCEAdapter(pool)
     else:
         raise NotImplementedError
     
 
 @click.group()
-def cli():
-    pass
+@click.option('--log-level', default='INFO', type=click.Choice(['DEBUG', 'INFO', 'WARNING', 'ERROR']),
+              help='DEBUG also logs the node lists and states every tick.')
+def cli(log_level):
+    logging.basicConfig(level=getattr(logging, log_level), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+
+def run_auto_scale_tick(adapter, lease=None):
+    metrics = adapter.metrics
+
+    with metrics.timer('tick'):
+        # One fleet listing shared by every step of this tick
+        with metrics.timer('list_nodes'):
+            snapshot = adapter.get_snapshot()
+
+        with metrics.timer('update_all_states'):
+            adapter.update_all_states(snapshot)
+        with metrics.timer('dump_state'):
+            states = adapter.dump_state(snapshot)
+        output_format = '{0: <30} {1}'
+        click.echo(output_format.format('Name', 'State'))
+        for name in states:
+            click.echo(output_format.format(name, states[name]['status']))
+
+        # Decided from this tick's snapshot, then carried out exactly as planned
+        with metrics.timer('plan'):
+            plan = adapter.plan(snapshot)
+
+        if plan.action == ElasticCloudAdapter.ACTION_DO_NOTHING:
+            click.echo('Service is in equilibrium. No need to shrink or expand right now!')
+        if plan.action == ElasticCloudAdapter.ACTION_SHRINK:
+            click.echo('Shrinking...')
+        if plan.action == ElasticCloudAdapter.ACTION_EXPAND:
+            click.echo('Expanding...')
+
+        # The fleet is only changed, and the states only written, while the lease is still ours
+        if lease is not None:
+            lease.check()
+        with metrics.timer('apply'):
+            message = adapter.apply(plan, snapshot)
+        if message:
+            click.echo(message)
+
+        with metrics.timer('refill_warm_pool'):
+            message = adapter.refill_warm_pool()
+        if message:
+            click.echo(message)
+
+        if lease is not None:
+            lease.check()
+        with metrics.timer('end_tick'):
+            adapter.end_tick()
+
+
+def run_leased_tick(adapter):
+    from StateStore import LeaseLostError
+
+    lease = adapter.state_lease()
+    if not lease.acquire():
+        click.echo('Another controller is in the middle of a tick, skipping this one.')
+        return
+
+    # Ticks can run longer than the lease ttl, waiting on probes, drains and GCE
+    lease.start_renewing()
+    try:
+        adapter.begin_tick()
+        run_auto_scale_tick(adapter, lease)
+    except LeaseLostError as e:
+        click.echo('{}, stopping this tick.'.format(e))
+    finally:
+        lease.release()
+
+
+def run_pool_ticks(adapters):
+    if len(adapters) == 1:
+        run_leased_tick(adapters[0])
+        return
+
+    # Every pool has its own states and lease, one failing does not hold the others back
+    for adapter in adapters:
+        click.echo('Pool {}:'.format(adapter.pool))
+        try:
+            run_leased_tick(adapter)
+        except Exception:
+            logger.exception('Tick of pool %s failed', adapter.pool)
 
 
 @cli.command()
+@click.option('--daemon', is_flag=True, help='Keep running and auto scale every --interval seconds.')
+@click.option('--interval', default=60, help='Seconds between ticks in daemon mode.')
+@click.option('--metrics-port', default=None, type=int, help='Serve Prometheus metrics on /metrics in daemon mode.')
+@click.option('--metrics-address', default='127.0.0.1', help='Address the metrics endpoint listens on.')
 @click.argument('driver', type=click.Choice(['gce']))
-def auto_scale(driver):
+def auto_scale(driver, daemon, interval, metrics_port, metrics_address):
     adapter = adapter_choice(driver)
+    # All pools are scaled in the same tick, each by its own policy
+    adapters = adapter.pool_adapters()
 
-    adapter.update_all_states()
-    states = adapter.dump_state()
-    output_format = '{0: <30} {1}'
-    click.echo(output_format.format('Name', 'State'))
-    for name in states:
-        click.echo(output_format.format(name, states[name]['status']))
-    
-    next_action, action_count = adapter.get_next_action()
-    
-    if next_action == ElasticCloudAdapter.ACTION_DO_NOTHING:
-        click.echo('Service is in equilibrium. No need to shrink or expand right now!')
+    if not daemon:
+        # Nothing listens for heartbeats in between, nodes are probed over ssh
+        run_pool_ticks(adapters)
+        # Waits for warm pool nodes still being created
+        close_adapters(adapter, adapters)
+        return
+
+    metrics_server = None
+    if metrics_port is not None:
+        from Metrics import MetricsServer
+        metrics_server = MetricsServer(adapter.metrics, metrics_port, metrics_address).start()
+        click.echo('Serving metrics on http://{}:{}/metrics'.format(metrics_address, metrics_server.port))
 
-    if next_action == ElasticCloudAdapter.ACTION_SHRINK:
-        click.echo('Shrinking...')
-        click.echo(adapter.shrink(action_count))
-            
-    if next_action == ElasticCloudAdapter.ACTION_EXPAND:
-        click.echo('Expanding...')
-        click.echo(adapter.expand(action_count))
+    if any(pool_adapter.probe_mode == 'heartbeat' for pool_adapter in adapters):
+        heartbeat_server = adapter.start_heartbeat_server()
+        click.echo('Receiving heartbeats on port {}'.format(heartbeat_server.port))
+
+    # The adapter, and with it the GCE driver, S3 client, ssh pool and state cache, lives for
+    # as long as the daemon does
+    loop = ControlLoop(lambda: run_pool_ticks(adapters), interval)
+    loop.install_signal_handlers()
+    click.echo('Auto scaling every {}s, stop with SIGTERM or Ctrl-C.'.format(interval))
+    loop.run()
+    close_adapters(adapter, adapters)
+    if metrics_server:
+        metrics_server.stop()
+
+
+def close_adapters(adapter, adapters):
+    for pool_adapter in adapters:
+        pool_adapter.close()
+    if adapter not in adapters:
+        # Still runs the heartbeat server the pools share
+        adapter.close()
 
 
 @cli.command()
+@click.option('--pool', default=None, help='Pool to work on, when the config has pools.')
 @click.argument('driver', type=click.Choice(['gce']))
-def dump_state(driver):
-    adapter = adapter_choice(driver)
+def dump_state(driver, pool):
+    adapter = adapter_choice(driver, pool)
 
-    adapter.update_all_states()
-    states = adapter.dump_state()
-    print("cloud.py: after dump-state")
+    snapshot = adapter.get_snapshot()
+    adapter.update_all_states(snapshot)
+    states = adapter.dump_state(snapshot)
     output_format = '{0: <30} {1}'
     click.echo(output_format.format('Name', 'State'))
     for name in states:
         click.echo(output_format.format(name, states[name]['status']))
 
+    adapter.end_tick()
+
 
 @cli.command()
 @click.option('--n', default=1)
+@click.option('--pool', default=None, help='Pool to work on, when the config has pools.')
 @click.argument('driver', type=click.Choice(['gce']))
-def shrink(n, driver):
-    adapter = adapter_choice(driver)
+def shrink(n, driver, pool):
+    adapter = adapter_choice(driver, pool)
     click.echo('Shrinking {} nodes...'.format(n))
     click.echo(adapter.shrink(n))
+    adapter.end_tick()
 
 
 @cli.command()
 @click.option('--n', default=1)
+@click.option('--pool', default=None, help='Pool to work on, when the config has pools.')
 @click.argument('driver', type=click.Choice(['gce']))
-def expand(n, driver):
-    adapter = adapter_choice(driver)
+def expand(n, driver, pool):
+    adapter = adapter_choice(driver, pool)
     click.echo('Expanding {} nodes...'.format(n))
     click.echo(adapter.expand(n))
-    
+    adapter.end_tick()
+
+
+@cli.command()
+@click.option('--pool', default=None, help='Pool to work on, when the config has pools.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the plan as json, as apply reads it.')
+@click.argument('driver', type=click.Choice(['gce']))
+def plan(driver, pool, as_json):
+    from ScalingPlan import plan_to_json
+
+    # What the next tick would do, nothing is done and the states are left as they are
+    adapter = adapter_choice(driver, pool)
+    snapshot = adapter.get_snapshot()
+    adapter.update_all_states(snapshot, restart=False)
+    scaling_plan = adapter.plan(snapshot)
+    if as_json:
+        click.echo(plan_to_json(scaling_plan))
+        return
+
+    click.echo('Action: {} {}'.format(scaling_plan.action, scaling_plan.count))
+    for label, names in (('Start', scaling_plan.start), ('Create', scaling_plan.create),
+                         ('Destroy', scaling_plan.destroy)):
+        if names:
+            click.echo('{}: {}'.format(label, ', '.join(names)))
+
+
+@cli.command()
+@click.option('--pool', default=None, help='Pool to work on, when the config has pools.')
+@click.argument('driver', type=click.Choice(['gce']))
+@click.argument('plan_file', type=click.File('r'), default='-')
+def apply(driver, pool, plan_file):
+    from ScalingPlan import StalePlanError, plan_from_json
+    from StateStore import LeaseLostError
+
+    # Carries out a plan made by plan --json, under the lease like a tick
+    adapter = adapter_choice(driver, pool)
+    scaling_plan = plan_from_json(plan_file.read())
+    lease = adapter.state_lease()
+    if not lease.acquire():
+        click.echo('Another controller is in the middle of a tick, try again later.')
+        return
+
+    lease.start_renewing()
+    try:
+        adapter.begin_tick()
+        message = adapter.apply(scaling_plan)
+        if message:
+            click.echo(message)
+        lease.check()
+        adapter.end_tick()
+    except (StalePlanError, LeaseLostError) as e:
+        raise click.ClickException(str(e))
+    finally:
+        lease.release()
+
+
+@cli.command()
+@click.option('--pool', default=None, help='Pool to read the journal of, when the config has pools.')
+@click.option('--since', default=0, help='Only lines after this seq.')
+@click.option('--state', is_flag=True, help='Print the node states rebuilt from the journal instead of its lines.')
+@click.argument('driver', type=click.Choice(['gce']))
+def journal(driver, pool, since, state):
+    import json
+
+    adapter = adapter_choice(driver, pool)
+    if state:
+        click.echo(json.dumps(adapter.journal.load(), indent=2))
+        return
+    # One json line per tick, ready to be replayed against a scaling policy
+    for line in adapter.journal.lines(after=since):
+        click.echo(json.dumps(line))
+
+
+@cli.command()
+@click.option('--ticks', default=None, type=int, help='Ticks to simulate, by default until the trace played out.')
+@click.option('--tick-seconds', default=60, help='Simulated seconds per tick.')
+@click.option('--trace', 'trace_file', default=None, type=click.Path(exists=True), help='Recorded "submitted,duration" trace in seconds.')
+@click.option('--arrival-rate', default=0.2, help='Synthetic trace: jobs submitted per tick.')
+@click.option('--mean-duration', default=10, help='Synthetic trace: mean job duration in ticks.')
+@click.option('--trace-ticks', default=1440, help='Synthetic trace: ticks during which jobs are submitted.')
+@click.option('--seed', default=None, type=int)
+@click.option('--boot-ticks', default=3, help='Ticks until a new node runs compute_worker.')
+@click.option('--max', 'max_nodes', default=10)
+@click.option('--min', 'min_nodes', default=1)
+@click.option('--shrink-sensitivity', default=3)
+@click.option('--expand-sensitivity', default=1)
+@click.option('--load-signal', default='ssh', type=click.Choice(['ssh', 'broker']))
+@click.option('--policy', default='counter', type=click.Choice(['counter', 'target']), help='Scaling policy.')
+@click.option('--target-utilization', default=0.75)
+@click.option('--max-scale-step', default=0, help='Most nodes created or destroyed in one tick, 0 for no bound.')
+@click.option('--scale-up-cooldown', default=0, help='Seconds after an expand before the next one.')
+@click.option('--scale-down-cooldown', default=0, help='Seconds after scaling before the next shrink.')
+@click.option('--predictive', is_flag=True, help='Counter policy: expand ahead of a rising trend of demand.')
+@click.option('--probe-mode', default='ssh', type=click.Choice(['ssh', 'heartbeat']), help='How nodes report their state.')
+@click.option('--warm-pool-size', default=0, help='Stopped nodes kept ready to start.')
+@click.option('--stop-on-shrink', is_flag=True, help='Stop drained nodes into the warm pool instead of destroying them.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the report as json.')
+def simulate(ticks, tick_seconds, trace_file, arrival_rate, mean_duration, trace_ticks, seed, boot_ticks,
+             max_nodes, min_nodes, shrink_sensitivity, expand_sensitivity, load_signal, policy, target_utilization,
+             max_scale_step, scale_up_cooldown, scale_down_cooldown, predictive, probe_mode, warm_pool_size,
+             stop_on_shrink, as_json):
+    # Imported here so the simulator's fakes never load for real runs
+    import json
+    from Simulator import Simulator, format_report, load_trace, synthetic_trace
+
+    if trace_file:
+        trace = load_trace(trace_file, tick_seconds)
+    else:
+        trace = synthetic_trace(trace_ticks, arrival_rate, mean_duration, seed)
+
+    config = {
+        'max': max_nodes,
+        'min': min_nodes,
+        'shrink_sensitivity': shrink_sensitivity,
+        'expand_sensitivity': expand_sensitivity,
+        'load_signal': load_signal,
+        'scaling_policy': policy,
+        'target_utilization': target_utilization,
+        'max_scale_step': max_scale_step,
+        'scale_up_cooldown': scale_up_cooldown,
+        'scale_down_cooldown': scale_down_cooldown,
+        'predictive_scaling': str(predictive),
+        'probe_mode': probe_mode,
+        'warm_pool_size': warm_pool_size,
+        'stop_on_shrink': str(stop_on_shrink),
+    }
+    report = Simulator(trace, config, boot_ticks=boot_ticks, tick_seconds=tick_seconds).run(ticks)
+
+    if as_json:
+        click.echo(json.dumps(report._asdict()))
+    else:
+        click.echo(format_report(report))
+
+
 if __name__ == '__main__':
     cli()
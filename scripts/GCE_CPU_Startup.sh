@@ -13,3 +13,7 @@ sudo -u bailey docker run -d -P --name web nginx
 sudo -u bailey docker ps
 EOF
 
+
+# Heartbeat sidecar, installed when the controller passed one in the instance metadata
+curl -sf -H "Metadata-Flavor: Google" \
+    http://metadata.google.internal/computeMetadata/v1/instance/attributes/elastic-cloud-heartbeat-script | sudo bash -s install
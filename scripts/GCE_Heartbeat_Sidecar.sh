@@ -0,0 +1,47 @@
+#!/bin/bash
+
+# Pushes a heartbeat to the elastic cloud controller every HEARTBEAT_INTERVAL seconds, so it
+# does not have to ssh into the node to probe it. The probe command, controller url and the
+# node's token come from the instance metadata, like the script itself. With "install" it
+# installs itself from there as a systemd service, the startup scripts run
+#
+#   curl -sf -H "Metadata-Flavor: Google" $ATTRIBUTES/elastic-cloud-heartbeat-script | sudo bash -s install
+
+ATTRIBUTES=http://metadata.google.internal/computeMetadata/v1/instance/attributes
+metadata() {
+    curl -sf -H "Metadata-Flavor: Google" $1
+}
+
+if [ "$1" = "install" ]; then
+    metadata $ATTRIBUTES/elastic-cloud-heartbeat-script > /usr/local/bin/elastic-cloud-heartbeat || exit 1
+    chmod +x /usr/local/bin/elastic-cloud-heartbeat
+    cat > /etc/systemd/system/elastic-cloud-heartbeat.service <<UNIT
+[Unit]
+Description=Elastic cloud heartbeat
+After=docker.service
+
+[Service]
+ExecStart=/usr/local/bin/elastic-cloud-heartbeat
+Restart=always
+
+[Install]
+WantedBy=multi-user.target
+UNIT
+    systemctl daemon-reload
+    systemctl enable --now elastic-cloud-heartbeat
+    exit 0
+fi
+
+NAME=$(metadata http://metadata.google.internal/computeMetadata/v1/instance/name)
+URL=$(metadata $ATTRIBUTES/elastic-cloud-heartbeat-url)
+TOKEN=$(metadata $ATTRIBUTES/elastic-cloud-heartbeat-token)
+PROBE=$(metadata $ATTRIBUTES/elastic-cloud-probe)
+INTERVAL=${HEARTBEAT_INTERVAL:-15}
+
+while true; do
+    probe=$(bash -c "$PROBE")
+    printf '{"name": "%s", "probe": %s}' "$NAME" "$probe" | \
+        curl -s -m 5 -X POST -H "Authorization: Bearer $TOKEN" -H "Content-Type: application/json" \
+        --data-binary @- $URL/heartbeat
+    sleep $INTERVAL
+done
@@ -0,0 +1,25 @@
+#!/bin/bash -x
+
+# Startup script of warm pool nodes, passed in the instance metadata by refill_warm_pool().
+# On the first boot the worker image is pulled and the node powers itself off, the controller
+# starts it when it needs capacity and runs "docker start compute_worker" once it answers.
+
+# Heartbeat sidecar, installed on every boot when the controller passed one in the instance metadata
+curl -sf -H "Metadata-Flavor: Google" \
+    http://metadata.google.internal/computeMetadata/v1/instance/attributes/elastic-cloud-heartbeat-script | sudo bash -s install
+
+MARKER=/var/lib/elastic-cloud/warmed
+WARM=$(curl -s -H "Metadata-Flavor: Google" \
+  http://metadata.google.internal/computeMetadata/v1/instance/attributes/elastic-cloud-warm)
+
+if [ -f $MARKER ] || [ "$WARM" != "true" ]; then
+    exit 0
+fi
+
+# The image starts compute_worker on boot, it must not pick up jobs from a pool node
+sudo docker stop compute_worker
+sudo docker pull $(sudo docker inspect --format '{{.Config.Image}}' compute_worker)
+
+sudo mkdir -p $(dirname $MARKER)
+sudo touch $MARKER
+sudo poweroff